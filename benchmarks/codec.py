@@ -0,0 +1,104 @@
+"""مسار رسائل التحكم داخل العملية: فك الترميز والتحقق والمعالج والترميز لكل مرمّز
+
+    python benchmarks/codec.py [--messages 10000] [--devices 200] [--json results.json]
+
+يمرر خليط COMMAND و GET_STATS عبر loads ثم validate ثم dispatch كما يفعل
+handler، مع أجهزة متصلة وهمية (بلا مقابس)، لكل مرمّز متاح دون تخزين لقطة
+STATS مؤقتاً (الافتراضي). ثم يقيس أثر STATS_CACHE_INTERVAL منفصلاً بالمرمّز
+المختار. النتيجة زمن المعالج لكل رسالة ومعدل الرسائل في الثانية.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import server  # noqa: E402
+
+
+class QuietSocket:
+    extensions = ()
+
+
+def connect_devices(count):
+    for i in range(count):
+        peer = server.Peer(QuietSocket())
+        peer.close()
+        peer.closed = False  # يقبل الرسائل في طابوره دون مهمة كتابة
+        peer.device_id = f"device-{i:04d}"
+        server.connected[peer.device_id] = peer
+        server.device_info[peer.device_id] = {"name": peer.device_id, "capabilities": []}
+
+
+def messages(count, devices):
+    texts = []
+    for i in range(count):
+        if i % 2:
+            texts.append(json.dumps({"type": "GET_STATS", "deviceId": "device-0000"}))
+        else:
+            texts.append(json.dumps({"type": "COMMAND", "deviceId": "device-0000",
+                                     "targetId": f"device-{i % devices:04d}",
+                                     "command": {"action": "take_photo", "quality": 80}}))
+    return texts
+
+
+async def run(texts, peer):
+    started = time.process_time()
+    for text in texts:
+        data = server.loads(text)
+        msg_type = data["type"]
+        if server.validate(msg_type, data) is None:
+            await server.dispatch(msg_type, server.HANDLERS[msg_type], peer, data)
+    elapsed = time.process_time() - started
+    for other in server.connected.values():
+        other.control.clear()
+    return elapsed
+
+
+async def measure(texts, peer, name, cache):
+    server.loads, server.dumps = server.SERIALIZERS[name]
+    server.STATS_CACHE_INTERVAL = cache
+    server._stats_cache["encode"] = None
+    await run(texts[:200], peer)  # إحماء
+    elapsed = await run(texts, peer)
+    result = {"serializer": name, "stats_cache": cache,
+              "us_per_message": round(elapsed * 1e6 / len(texts), 2),
+              "messages_per_second": round(len(texts) / elapsed)}
+    print(f"{name:<8} stats cache {cache:>3}s  {result['us_per_message']:>8.2f} us/msg  "
+          f"{result['messages_per_second']:>9} msg/s")
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--json", help="كتابة النتائج في ملف JSON")
+    args = parser.parse_args()
+
+    connect_devices(args.devices)
+    peer = server.connected["device-0000"]
+    texts = messages(args.messages, args.devices)
+    # مقارنة المرمّزات بلا تخزين مؤقت: كل GET_STATS يبني لقطته ويرمّزها
+    results = []
+    for name in server.SERIALIZERS:
+        results.append(await measure(texts, peer, name, 0.0))
+
+    # أثر التخزين المؤقت (اختياري) بالمرمّز المختار، منفصلاً عن المقارنة
+    print("STATS_CACHE_INTERVAL:")
+    stats_cache = [await measure(texts, peer, server.SERIALIZER_NAME, cache) for cache in (0.0, 1.0)]
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "codec", "messages": len(texts), "devices": args.devices,
+                       "event_loop": type(asyncio.get_running_loop()).__module__,
+                       "results": results, "stats_cache": stats_cache}, f, indent=2)
+
+
+if __name__ == "__main__":
+    server.install_event_loop()
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+"""قياس تكلفة الضغط: زمن المعالج لكل ميغابايت مُرحَّل ونسبة الحجم لكل إعداد
+
+    python benchmarks/compression.py [--rounds 20] [--json results.json]
+
+يرمّز مزيجاً يشبه حركة السيرفر (قوائم أجهزة وإحصائيات، إطارات فيديو ثنائية،
+صور JSON/base64) عبر امتدادات permessage-deflate نفسها التي يستخدمها السيرفر.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from websockets.frames import Frame, OP_BINARY, OP_TEXT  # noqa: E402
+
+import server  # noqa: E402
+
+
+def traffic():
+    """رسائل تمثيلية: (النوع، opcode، البيانات)"""
+    devices = [{"id": f"device-{i:04d}", "name": f"جهاز {i}", "capabilities": ["camera", "mic"],
+                "last_seen": time.time(), "commandAcks": False, "status": "online"}
+               for i in range(200)]
+    device_list = json.dumps({"type": "DEVICE_LIST", "devices": devices, "count": len(devices)})
+    stats = json.dumps({"type": "STATS", "queues": {d["id"]: {"depth": 0, "dropped": 0} for d in devices}})
+    command = json.dumps({"type": "COMMAND", "messageId": "w-1", "command": "take_photo", "fromId": "panel"})
+    # JPEG/H.264 مضغوطة أصلاً: بايتات عشوائية (مختلفة لكل إطار) تمثلها بدقة كافية
+    videos = [server.pack_media(server.MediaFrame("VIDEO_FRAME", "cam-1", sequence=i,
+                                                  payload=os.urandom(20_000)))
+              for i in range(300)]
+    photos = [json.dumps({"type": "PHOTO", "deviceId": "cam-1",
+                          "image": base64.b64encode(os.urandom(60_000)).decode()})
+              for _ in range(10)]
+    
+    messages = [("DEVICE_LIST", OP_TEXT, device_list.encode())]
+    messages += [("STATS", OP_TEXT, stats.encode())] * 5
+    messages += [("COMMAND", OP_TEXT, command.encode())] * 50
+    messages += [("VIDEO_FRAME", OP_BINARY, video) for video in videos]
+    messages += [("PHOTO", OP_TEXT, photo.encode()) for photo in photos]
+    return messages
+
+
+def deflate(aware, window_bits, mem_level, level=6):
+    cls = server.PayloadAwareDeflate if aware else server.PerMessageDeflate
+    return cls(False, False, window_bits, window_bits, {"memLevel": mem_level, "level": level})
+
+
+def run(name, mix, make_extension, messages, rounds, zstd=False):
+    extension = make_extension() if make_extension else None
+    raw = wire = 0
+    started = time.process_time()
+    for _ in range(rounds):
+        for kind, opcode, data in messages:
+            raw += len(data)
+            if zstd and kind in server.ZSTD_TYPES and len(data) >= server.ZSTD_MIN_SIZE:
+                data = server.zstd_compress(data.decode())
+                opcode = OP_BINARY
+            if extension is None:
+                wire += len(data)
+                continue
+            if isinstance(extension, server.PayloadAwareDeflate):
+                extension.skip = kind in server.MEDIA_TYPES
+            wire += len(extension.encode(Frame(opcode, data)).data)
+    cpu = time.process_time() - started
+    megabytes = raw / 1e6
+    return {"setting": name, "mix": mix, "cpu_ms_per_mb": round(cpu * 1000 / megabytes, 3),
+            "wire_ratio": round(wire / raw, 4), "mb": round(megabytes, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--json", help="كتابة النتائج في ملف JSON")
+    args = parser.parse_args()
+    
+    messages = traffic()
+    settings = [
+        ("none", None, False),
+        ("deflate 15/8 all messages", lambda: deflate(False, 15, 8), False),
+        ("deflate 12/5 all messages", lambda: deflate(False, 12, 5), False),
+        ("deflate 12/5 payload-aware", lambda: deflate(True, 12, 5), False),
+        ("deflate 12/5 level 1 payload-aware", lambda: deflate(True, 12, 5, 1), False),
+    ]
+    if server.zstandard is not None:
+        settings.append(("zstd control + deflate payload-aware", lambda: deflate(True, 12, 5), True))
+    
+    control = [message for message in messages if message[0] not in server.MEDIA_TYPES]
+    results = []
+    for mix, selected in (("all", messages), ("control", control)):
+        for name, factory, zstd in settings:
+            result = run(name, mix, factory, selected, args.rounds, zstd)
+            results.append(result)
+            print(f"{mix:<8} {name:<38} {result['cpu_ms_per_mb']:>9.2f} ms/MB  "
+                  f"wire {result['wire_ratio'] * 100:6.1f}%")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "compression", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""حمل تجريبي للسيرفر: أجهزة محاكاة كثيرة ونتائج قابلة للمقارنة بين الإصدارات
+
+    python benchmarks/relay.py [--devices 500] [--rate 5] [--duration 10] \
+        [--formats json,binary] [--mix video=60,audio=25,photo=5,command=10] \
+        [--server-env SERIALIZER=json] [--output relay_results.json]
+
+يشغّل main() في عملية مستقلة على منفذ محلي، ثم يوزع الأجهزة على عمليات عميل:
+كل جهاز يسجل ثم يرسل خليطاً من الرسائل بالمعدل المطلوب، وأجهزة العرض تستقبل
+الوسائط. يُقاس معدل الإرسال والاستقبال، وتأخر التوصيل (p50/p99) لكل نوع،
+ونمو ذاكرة السيرفر، وتأخر حلقة الأحداث من /metrics.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+MEDIA_KINDS = {"video": "VIDEO_FRAME", "audio": "AUDIO_STREAM", "photo": "PHOTO"}
+
+
+# ----- السيرفر -----
+def run_server(port, env):
+    """العملية الفرعية: الإعدادات تُقرأ عند الاستيراد، لذا يُضبط env أولاً"""
+    os.environ.update(env)
+    os.chdir(tempfile.mkdtemp(prefix="relay-bench-"))
+    import server
+    asyncio.run(server.main(host="127.0.0.1", port=port))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def cpu_seconds(pid):
+    """زمن المعالج (user + system) للعملية من /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def fetch_metrics(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        return response.read().decode("utf-8")
+
+
+def histogram(text, name):
+    """حدود المدرج التراكمي ومجموعه وعدده من نص Prometheus"""
+    buckets, total, count = [], 0.0, 0
+    for line in text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            bound = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets.append((float(bound), float(line.rsplit(" ", 1)[1])))
+        elif line.startswith(f"{name}_sum"):
+            total = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_count"):
+            count = float(line.rsplit(" ", 1)[1])
+    return buckets, total, count
+
+
+def bucket_quantile(buckets, count, q):
+    rank = q * count
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            return bound
+    return float("inf")
+
+
+# ----- العملاء -----
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples.sort()
+    at = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {"count": len(samples), "p50_ms": round(at(0.5) * 1000, 3),
+            "p99_ms": round(at(0.99) * 1000, 3), "max_ms": round(samples[-1] * 1000, 3)}
+
+
+def client_process(port, device_ids, viewer_ids, config, results):
+    results.put(asyncio.run(run_clients(port, device_ids, viewer_ids, config)))
+
+
+async def run_clients(port, device_ids, viewer_ids, config):
+    import websockets
+    import server
+
+    uri = f"ws://127.0.0.1:{port}"
+    binary = config["format"] == "binary"
+    weights = config["mix"]
+    sizes = {"video": config["payload"], "audio": max(1, config["payload"] // 4),
+             "photo": config["payload"] * 4}
+    payloads = {kind: os.urandom(size) for kind, size in sizes.items()}
+    encoded = {kind: base64.b64encode(data).decode() for kind, data in payloads.items()}
+    sent = {kind: 0 for kind in weights}
+    received = {}
+    latencies = {kind: [] for kind in list(weights) + ["media"]}
+    stats_pending = {}
+    errors = 0
+    running = True
+    gate = asyncio.Semaphore(100)
+
+    async def connect(device_id, viewer):
+        async with gate:
+            ws = await websockets.connect(uri, max_size=None, ping_interval=None,
+                                          compression=config["compression"])
+            await ws.send(json.dumps({"type": "REGISTER", "deviceId": device_id,
+                                      "capabilities": ["display"] if viewer else ["camera"],
+                                      "binary": binary}))
+            return ws
+
+    async def receive(device_id, ws):
+        nonlocal errors
+        async for message in ws:
+            now = time.time()
+            if isinstance(message, bytes):
+                frame = server.unpack_media(message)
+                kind, sent_at = frame.kind, server.client_time(frame.timestamp)
+            else:
+                data = json.loads(message)
+                kind = data.get("type")
+                sent_at = None
+                if kind in server.MEDIA_TYPES:
+                    sent_at = server.client_time(data.get("timestamp"))
+                elif kind == "COMMAND":
+                    sent_at = data["command"]["sentAt"] / 1000
+                    latencies["command"].append(now - sent_at)
+                    sent_at = None
+                elif kind == "STATS" and stats_pending.get(device_id):
+                    latencies["stats"].append(now - stats_pending[device_id].pop(0))
+                elif kind == "ERROR":
+                    errors += 1
+            received[kind] = received.get(kind, 0) + 1
+            if sent_at is not None:
+                latencies["media"].append(now - sent_at)
+
+    async def produce(device_id, ws):
+        kinds, cumulative = list(weights), list(weights.values())
+        interval = 1 / config["rate"]
+        sequence = 0
+        await asyncio.sleep(random.random() * interval)
+        while running:
+            kind = random.choices(kinds, cumulative)[0]
+            sequence += 1
+            ts = time.time() * 1000
+            if kind in MEDIA_KINDS:
+                if binary:
+                    frame = server.MediaFrame(MEDIA_KINDS[kind], device_id, sequence=sequence,
+                                              timestamp=ts, payload=payloads[kind],
+                                              meta={"streamId": "bench"} if kind == "audio" else None)
+                    await ws.send(server.pack_media(frame))
+                else:
+                    field = server.MEDIA_PAYLOAD_FIELDS[MEDIA_KINDS[kind]]
+                    await ws.send(json.dumps({"type": MEDIA_KINDS[kind], "deviceId": device_id,
+                                              field: encoded[kind], "sequence": sequence,
+                                              "streamId": "bench", "timestamp": ts}))
+            elif kind == "command":
+                await ws.send(json.dumps({"type": "COMMAND", "targetId": random.choice(device_ids),
+                                          "command": {"action": "bench", "sentAt": ts}}))
+            elif kind == "stats":
+                stats_pending.setdefault(device_id, []).append(time.time())
+                await ws.send(json.dumps({"type": "GET_STATS"}))
+            sent[kind] += 1
+            await asyncio.sleep(interval)
+
+    sockets = await asyncio.gather(*(connect(dev_id, False) for dev_id in device_ids),
+                                   *(connect(dev_id, True) for dev_id in viewer_ids))
+    ids = list(device_ids) + list(viewer_ids)
+    readers = [asyncio.create_task(receive(dev_id, ws)) for dev_id, ws in zip(ids, sockets)]
+    await asyncio.sleep(config["settle"])
+
+    started = time.time()
+    producers = [asyncio.create_task(produce(dev_id, ws))
+                 for dev_id, ws in zip(device_ids, sockets)]
+    await asyncio.sleep(config["duration"])
+    running = False
+    await asyncio.gather(*producers, return_exceptions=True)
+    elapsed = time.time() - started
+    await asyncio.sleep(config["settle"])
+
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+    return {"elapsed": elapsed, "sent": sent, "received": received,
+            "latencies": latencies, "errors": errors}
+
+
+# ----- التشغيل -----
+def run_format(args, fmt):
+    ctx = multiprocessing.get_context("spawn")
+    port = free_port()
+    env = {"PORT": str(port), "LOG_LEVEL": args.log_level, "COMPRESSION": args.compression}
+    env.update(item.split("=", 1) for item in args.server_env)
+    server_process = ctx.Process(target=run_server, args=(port, env), daemon=True)
+    server_process.start()
+    for _ in range(100):
+        try:
+            fetch_metrics(port)
+            break
+        except OSError:
+            time.sleep(0.1)
+    rss_idle = rss_bytes(server_process.pid)
+    cpu_idle = cpu_seconds(server_process.pid)
+
+    config = {"format": fmt, "mix": args.mix, "rate": args.rate, "payload": args.payload,
+              "duration": args.duration, "settle": args.settle,
+              "compression": "deflate" if args.compression == "deflate" else None}
+    device_ids = [f"bench-{i:05d}" for i in range(args.devices)]
+    viewer_ids = [f"viewer-{i:03d}" for i in range(args.viewers)]
+    shares = [device_ids[i::args.client_processes] for i in range(args.client_processes)]
+    results = ctx.Queue()
+    clients = [ctx.Process(target=client_process,
+                           args=(port, share, viewer_ids if i == 0 else [], config, results))
+               for i, share in enumerate(shares)]
+    for client in clients:
+        client.start()
+
+    rss_peak = rss_idle or 0
+    outputs = []
+    while len(outputs) < len(clients):
+        try:
+            outputs.append(results.get(timeout=0.5))
+        except Exception:
+            rss_peak = max(rss_peak, rss_bytes(server_process.pid) or 0)
+            if not any(client.is_alive() for client in clients) and results.empty():
+                raise RuntimeError("انتهت عمليات العميل دون نتائج")
+    for client in clients:
+        client.join()
+    rss_end = rss_bytes(server_process.pid)
+    cpu_end = cpu_seconds(server_process.pid)
+    metrics_text = fetch_metrics(port)
+    server_process.terminate()
+    server_process.join()
+
+    elapsed = max(output["elapsed"] for output in outputs)
+    sent, received, latencies, errors = {}, {}, {}, 0
+    for output in outputs:
+        errors += output["errors"]
+        for kind, count in output["sent"].items():
+            sent[kind] = sent.get(kind, 0) + count
+        for kind, count in output["received"].items():
+            received[kind] = received.get(kind, 0) + count
+        for kind, samples in output["latencies"].items():
+            latencies.setdefault(kind, []).extend(samples)
+
+    buckets, lag_sum, lag_count = histogram(metrics_text, "relay_event_loop_lag_seconds")
+    return {
+        "format": fmt,
+        "sent": sent,
+        "received": received,
+        "errors": errors,
+        "throughput_in": round(sum(sent.values()) / elapsed, 1),
+        "throughput_out": round(sum(received.values()) / elapsed, 1),
+        "latency": {kind: percentiles(samples) for kind, samples in latencies.items() if samples},
+        "server_cpu": {"seconds": round(cpu_end - cpu_idle, 2) if cpu_idle is not None else None,
+                       "us_per_message": round((cpu_end - cpu_idle) * 1e6 / max(1, sum(sent.values())), 1)
+                       if cpu_idle is not None else None},
+        "memory": {"rss_idle": rss_idle, "rss_peak": rss_peak, "rss_end": rss_end,
+                   "growth": rss_end - rss_idle if rss_idle and rss_end else None},
+        "loop_lag": {"mean_ms": round(lag_sum / lag_count * 1000, 3) if lag_count else None,
+                     "p99_le_ms": round(bucket_quantile(buckets, lag_count, 0.99) * 1000, 3)
+                     if lag_count else None},
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in MEDIA_KINDS and kind not in ("command", "stats"):
+            raise argparse.ArgumentTypeError(f"نوع غير معروف: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500, help="أجهزة مرسلة")
+    parser.add_argument("--viewers", type=int, default=5, help="أجهزة عرض تستقبل كل الوسائط")
+    parser.add_argument("--rate", type=float, default=5, help="رسائل في الثانية لكل جهاز")
+    parser.add_argument("--payload", type=int, default=4096, help="حجم إطار الفيديو بالبايت")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--settle", type=float, default=1.0, help="انتظار قبل القياس وبعده")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("video=60,audio=25,photo=5,command=10"))
+    parser.add_argument("--formats", default="json,binary")
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--compression", default="deflate", choices=("deflate", "none"))
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="متغير بيئة للسيرفر، مثل SERIALIZER=json أو EVENT_LOOP=asyncio")
+    parser.add_argument("--output", default="relay_results.json")
+    args = parser.parse_args()
+
+    runs = []
+    for fmt in args.formats.split(","):
+        result = run_format(args, fmt)
+        runs.append(result)
+        latency = "  ".join(f"{kind} p50 {value['p50_ms']} p99 {value['p99_ms']} ms"
+                            for kind, value in result["latency"].items())
+        print(f"{fmt:<7} in {result['throughput_in']:>9.1f} msg/s  out {result['throughput_out']:>9.1f} msg/s  "
+              f"cpu {result['server_cpu']['us_per_message']} us/msg  {latency}  "
+              f"rss +{(result['memory']['growth'] or 0) / 1e6:.1f} MB  "
+              f"loop lag mean {result['loop_lag']['mean_ms']} ms  errors {result['errors']}")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "benchmark": "relay",
+            "revision": git_revision(),
+            "timestamp": time.time(),
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "runs": runs,
+        }, f, indent=2)
+    print(f"النتائج: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
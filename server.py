@@ -3,521 +3,3659 @@ import websockets
 import json
 import os
 import base64
+import bisect
+import glob
+import http
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
 import time
+import atexit
+import itertools
+import uuid
+import multiprocessing
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+try:
+    import zstandard
+except ImportError:  # اختياري: ضغط zstd لدفعات التحكم
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # اختياري: ترميز JSON أسرع
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # اختياري: بديل لـ orjson
+    msgspec = None
+
+try:
+    import uvloop
+except ImportError:  # اختياري: حلقة أحداث أسرع
+    uvloop = None
 
 # ==================== الإعدادات ====================
 PORT = int(os.environ.get("PORT", 10000))
-connected = {}  # الأجهزة المتصلة {device_id: websocket}
+connected = {}  # الأجهزة المتصلة {device_id: Peer}
 device_info = {}  # معلومات الأجهزة {device_id: {name, capabilities, last_seen}}
-audio_buffers = defaultdict(list)  # مخازن الصوت المؤقتة
-video_buffers = defaultdict(list)  # مخازن الفيديو المؤقتة
+offline_devices = OrderedDict()  # أجهزة غير متصلة ما زالت معلوماتها محفوظة (الأقدم أولاً)
+pending_commands = defaultdict(deque)  # أوامر تنتظر اتصال الجهاز {device_id: deque}
+inflight_commands = {}  # أوامر أُرسلت وتنتظر COMMAND_ACK {message_id: entry}
+queued_commands = {}  # فهرس كل أوامر pending_commands لحدها الكلي وانتهاء عمرها {message_id: entry}
+audio_sessions = {}  # جلسات البث الصوتي الجارية {(device_id, stream_id): AudioStreamSession}
+video_recordings = {}  # تسجيلات الفيديو الجارية {device_id: VideoRecording}
+recording_sources = set()  # أجهزة فُعّل تسجيلها بـ START_RECORDING
+uploads = {}  # الرفع المجزأ الجاري {(device_id, upload_id): ChunkedUpload}
+
+# حد طابور الوسائط المباشرة لكل اتصال (يُحذف الأقدم عند الامتلاء)
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 64))
+# حد طابور الوسائط غير المباشرة (الصور والتسجيلات) بالبايت لكل اتصال (يُحذف الأقدم عند التجاوز)
+MEDIA_QUEUE_BYTES = int(os.environ.get("MEDIA_QUEUE_BYTES", 32 * 1024 * 1024))
+LIVE_TYPES = {"VIDEO_FRAME", "AUDIO_STREAM"}
+
+# حدود الوارد: أقصى حجم للرسالة حسب النوع كما تصل (base64 يزيد الحجم بنحو الثلث)،
+# مثل "PHOTO=12582912,AUDIO=4194304"، وحد رسائل التحكم وحد websockets نفسه
+SIZE_LIMITS = {
+    "VIDEO_FRAME": 2 * 1024 * 1024,
+    "PHOTO": 12 * 1024 * 1024,
+    "AUDIO": 12 * 1024 * 1024,
+    "AUDIO_STREAM": 1024 * 1024,
+    "UPLOAD_CHUNK": 1024 * 1024,
+}
+SIZE_LIMITS.update(
+    (name, int(limit)) for name, limit in
+    (item.split("=", 1) for item in filter(None, os.environ.get("SIZE_LIMITS", "").split(",")))
+)
+CONTROL_MAX_SIZE = int(os.environ.get("CONTROL_MAX_SIZE", 256 * 1024))
+LARGEST_SIZE_LIMIT = max(CONTROL_MAX_SIZE, *SIZE_LIMITS.values())
+MAX_MESSAGE_SIZE = int(os.environ.get("MAX_MESSAGE_SIZE", max(SIZE_LIMITS.values())))
+# عدد الرسائل المستلمة التي تنتظر المعالج لكل اتصال (websockets max_queue)
+INBOUND_QUEUE = int(os.environ.get("INBOUND_QUEUE", 8))
+# ميزانية الوارد لكل جهاز (دلو رموز): بايت/ثانية (0 = بلا حد)، السعة، وأقصى إبطاء قبل الحذف
+INBOUND_RATE = int(os.environ.get("INBOUND_RATE", 8 * 1024 * 1024))
+INBOUND_BURST = int(os.environ.get("INBOUND_BURST", max(MAX_MESSAGE_SIZE, INBOUND_RATE)))
+INBOUND_MAX_DELAY = float(os.environ.get("INBOUND_MAX_DELAY", 2.0))
+# الرفع المجزأ: أقصى حجم للملف ومهلة الرفع المنقطع قبل حذف الجزء المكتوب
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 1024 * 1024 * 1024))
+UPLOAD_TIMEOUT = float(os.environ.get("UPLOAD_TIMEOUT", 120))
+
+# التشغيل المسرّع: مرمّز JSON (auto / orjson / msgspec / json) وحلقة الأحداث (auto / uvloop / asyncio)
+SERIALIZER = os.environ.get("SERIALIZER", "auto")
+EVENT_LOOP = os.environ.get("EVENT_LOOP", "auto")
+# مدة إعادة استخدام لقطة GET_STATS بالثواني (0 = لقطة جديدة لكل طلب؛ القيمة
+# الموجبة تخفف حمل الطلبات المتكررة مقابل إحصائيات متأخرة حتى هذه المدة)
+STATS_CACHE_INTERVAL = float(os.environ.get("STATS_CACHE_INTERVAL", 0))
+
+# التوسع الأفقي: عدد العمليات، عنوان الناقل المشترك (فارغ = داخل العملية،
+# unix:///path = موزع محلي، redis://host:port = Redis أو بديل متوافق)
+WORKERS = int(os.environ.get("WORKERS", 1))
+BUS_URL = os.environ.get("BUS_URL", "")
+CLUSTER_HEARTBEAT = float(os.environ.get("CLUSTER_HEARTBEAT", 5))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# السجلات: المستوى، الصيغة (json / text)، والأحداث عالية التكرار التي تُسجَّل بالعينة
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_SAMPLE_INTERVAL = float(os.environ.get("LOG_SAMPLE_INTERVAL", 5))
+SAMPLED_EVENTS = set(filter(None, os.environ.get("SAMPLED_EVENTS", "VIDEO,AUDIO_STREAM").split(",")))
+
+# الحفظ على القرص: عدد خيوط الكتابة، حد الطابور، وسياسة fsync (none / always / interval)
+DISK_WRITERS = int(os.environ.get("DISK_WRITERS", 2))
+DISK_QUEUE_SIZE = int(os.environ.get("DISK_QUEUE_SIZE", 256))
+FSYNC_POLICY = os.environ.get("FSYNC_POLICY", "none")
+FSYNC_INTERVAL = float(os.environ.get("FSYNC_INTERVAL", 1.0))
+MEDIA_FOLDERS = ("received_videos", "received_photos", "received_audio", "received_audio_streams")
+
+# البث الصوتي: نافذة إعادة الترتيب (عدد الأجزاء) ومهلة الجلسة المنقطعة قبل إغلاقها
+AUDIO_REORDER_WINDOW = int(os.environ.get("AUDIO_REORDER_WINDOW", 16))
+AUDIO_SESSION_TIMEOUT = float(os.environ.get("AUDIO_SESSION_TIMEOUT", 300))
+
+# تسجيل الفيديو: معطل افتراضياً (إعادة التوجيه فقط بلا فك تشفير)، مع حدود تدوير المقاطع
+RECORD_VIDEO = os.environ.get("RECORD_VIDEO", "0") == "1"
+SEGMENT_MAX_BYTES = int(os.environ.get("SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+SEGMENT_MAX_SECONDS = float(os.environ.get("SEGMENT_MAX_SECONDS", 300))
+VIDEO_SESSION_TIMEOUT = float(os.environ.get("VIDEO_SESSION_TIMEOUT", 60))
+
+# الأجهزة التي تعلن إحدى هذه الإمكانيات تُشترك تلقائياً في وسائط جميع المصادر
+VIEWER_CAPABILITIES = set(filter(None, os.environ.get("VIEWER_CAPABILITIES", "viewer,display,monitor").split(",")))
+# السلوك القديم: الجهاز الذي لم يشترك في أي شيء يستقبل كل الوسائط
+MEDIA_BROADCAST_FALLBACK = os.environ.get("MEDIA_BROADCAST_FALLBACK", "0") == "1"
+
+# ذاكرة اللحاق: آخر إطارات الفيديو (منذ آخر إطار مفتاحي) وآخر صورة لكل مصدر، بحد كلي للذاكرة
+CATCHUP_FRAMES = int(os.environ.get("CATCHUP_FRAMES", 30))
+CATCHUP_MAX_BYTES = int(os.environ.get("CATCHUP_MAX_BYTES", 64 * 1024 * 1024))
+CATCHUP_KINDS = {"VIDEO_FRAME", "PHOTO"}
+
+# الحضور: نافذة تجميع الأحداث (مللي ثانية) وعدد الأحداث المحفوظة لتدارك الفجوات
+PRESENCE_COALESCE = float(os.environ.get("PRESENCE_COALESCE_MS", 100)) / 1000
+PRESENCE_LOG_SIZE = int(os.environ.get("PRESENCE_LOG_SIZE", 1024))
+# الضغط: none أو deflate (permessage-deflate مضبوط لرسائل التحكم، والوسائط تُرسل بلا ضغط)
+COMPRESSION = os.environ.get("COMPRESSION", "deflate")
+DEFLATE_WINDOW_BITS = int(os.environ.get("DEFLATE_WINDOW_BITS", 12))
+DEFLATE_MEM_LEVEL = int(os.environ.get("DEFLATE_MEM_LEVEL", 5))
+DEFLATE_LEVEL = int(os.environ.get("DEFLATE_LEVEL", 6))
+DEFLATE_MIN_SIZE = int(os.environ.get("DEFLATE_MIN_SIZE", 256))
+# zstd للعملاء الذين يطلبونه في REGISTER (compression: "zstd") لرسائل التحكم الكبيرة فقط
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+ZSTD_MIN_SIZE = int(os.environ.get("ZSTD_MIN_SIZE", 1024))
+ZSTD_TYPES = {"DEVICE_LIST", "PRESENCE_BATCH", "COMMAND_BATCH", "STATS"}
+
+# نبض الحضور: مهلة الصمت قبل فحص الاتصال بـ ping، ومهلة الرد عليه، ودقة عجلة المؤقتات
+PRESENCE_TIMEOUT = float(os.environ.get("PRESENCE_TIMEOUT", 60))
+PRESENCE_PROBE_TIMEOUT = float(os.environ.get("PRESENCE_PROBE_TIMEOUT", 10))
+TIMER_TICK = float(os.environ.get("TIMER_TICK", 1.0))
+# الأجهزة غير المتصلة: أقصى عدد يُحتفظ بمعلوماته (الأقدم يُحذف أولاً) ومدة الاحتفاظ
+OFFLINE_DEVICE_LIMIT = int(os.environ.get("OFFLINE_DEVICE_LIMIT", 10000))
+OFFLINE_DEVICE_TTL = float(os.environ.get("OFFLINE_DEVICE_TTL", 24 * 3600))
+
+# الأوامر الموثوقة: حد طابور الجهاز غير المتصل، الحد الكلي لكل الأجهزة، مهلة التأكيد،
+# عدد المحاولات، عمر الأمر، وملف حفظ الأوامر المعلقة (فارغ = في الذاكرة فقط؛ عند
+# التوسع الأفقي لكل عامل ملفه <الملف>.<pid> وتُضم ملفات العمال المتوقفين)
+COMMAND_QUEUE_SIZE = int(os.environ.get("COMMAND_QUEUE_SIZE", 100))
+COMMAND_QUEUE_TOTAL = int(os.environ.get("COMMAND_QUEUE_TOTAL", 10000))
+COMMAND_ACK_TIMEOUT = float(os.environ.get("COMMAND_ACK_TIMEOUT", 10))
+COMMAND_RETRIES = int(os.environ.get("COMMAND_RETRIES", 3))
+COMMAND_TTL = float(os.environ.get("COMMAND_TTL", 3600))
+COMMAND_QUEUE_FILE = os.environ.get("COMMAND_QUEUE_FILE", "")
+
+# الإيقاف التدريجي (SIGTERM / SIGINT): مهلة تفريغ الطوابير وانتهاء الاتصالات، ونطاق المهلة
+# العشوائية التي يُطلب من كل عميل انتظارها قبل إعادة الاتصال حتى لا يعودوا معاً
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 10))
+RECONNECT_DELAY_MIN = float(os.environ.get("RECONNECT_DELAY_MIN", 1))
+RECONNECT_DELAY_MAX = float(os.environ.get("RECONNECT_DELAY_MAX", 15))
+# إعادة التشغيل دون انقطاع (SIGHUP): تضبطها النسخة القديمة للجديدة، مقبس الاستماع الموروث
+# وأنبوب إبلاغ الجاهزية وأنبوب تسليم الأوامر المعلقة
+LISTEN_FD = os.environ.get("LISTEN_FD", "")
+READY_FD = os.environ.get("READY_FD", "")
+HANDOFF_FD = os.environ.get("HANDOFF_FD", "")
+
+# إحصائيات
+stats = {
+    "total_connections": 0,
+    "total_frames": 0,
+    "total_photos": 0,
+    "total_audio": 0,
+    "dropped_frames": 0,
+    "start_time": time.time()
+}
+
+
+# ==================== السجلات ====================
+# الطباعة تتم في خيط منفصل عبر QueueHandler فلا تحجب حلقة الأحداث
+EVENT_LEVELS = {
+    "ERROR": logging.ERROR,
+    "FATAL": logging.CRITICAL,
+    "WARNING": logging.WARNING,
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """سطر JSON واحد لكل حدث"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": getattr(record, "event", "INFO"),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """الصيغة القديمة المقروءة: [الوقت] النوع: الرسالة"""
+
+    def format(self, record):
+        timestamp = datetime.fromtimestamp(record.created).strftime("%H:%M:%S")
+        fields = getattr(record, "fields", {})
+        extra = " " + " ".join(f"{k}={v}" for k, v in fields.items()) if fields else ""
+        return f"[{timestamp}] {getattr(record, 'event', 'INFO')}: {record.getMessage()}{extra}"
+
+
+def setup_logging():
+    """تهيئة مسجل غير حاجب: QueueHandler في حلقة الأحداث ومستمع يكتب في خيط خلفي"""
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    relay_logger = logging.getLogger("relay")
+    relay_logger.setLevel(LOG_LEVEL)
+    relay_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    relay_logger.propagate = False
+    return relay_logger
+
+
+logger = setup_logging()
+_log_samples = {}  # {(الحدث، الجهاز): [بداية النافذة، عدد المحذوف]}
+
+
+def log(message, type="INFO", device=None, **fields):
+    """تسجيل حدث منظم
+
+    الأحداث في SAMPLED_EVENTS تُسجَّل مرة واحدة كل LOG_SAMPLE_INTERVAL لكل
+    جهاز، مع عدد ما حُذف منذ آخر سطر.
+    """
+    level = EVENT_LEVELS.get(type, logging.INFO)
+    if not logger.isEnabledFor(level):
+        return
+    
+    if type in SAMPLED_EVENTS:
+        key = (type, device)
+        now = time.monotonic()
+        sample = _log_samples.get(key)
+        if sample is not None and now - sample[0] < LOG_SAMPLE_INTERVAL:
+            sample[1] += 1
+            return
+        if sample is not None and sample[1]:
+            fields["suppressed"] = sample[1]
+        _log_samples[key] = [now, 0]
+    
+    if device is not None:
+        fields["device"] = device
+    logger.log(level, message, extra={"event": type, "fields": fields})
+
+
+def forget_log_samples(device_id):
+    """حذف حالة العينات لجهاز منفصل"""
+    for key in [key for key in _log_samples if key[1] == device_id]:
+        del _log_samples[key]
+
+
+# ==================== دوال مساعدة ====================
+
+
+def format_size(size_bytes):
+    """تنسيق حجم الملف"""
+    if size_bytes < 1024:
+        return f"{size_bytes} B"
+    elif size_bytes < 1024 * 1024:
+        return f"{size_bytes / 1024:.1f} KB"
+    else:
+        return f"{size_bytes / (1024 * 1024):.1f} MB"
+
+
+def safe_filename(name):
+    """اسم ملف (أو مكون مسار) من العميل بلا مسارات أو رموز خاصة، ولا يبدأ بنقطة"""
+    return re.sub(r"[^\w.-]", "_", os.path.basename(str(name)))[:100].lstrip(".") or "_"
+
+
+# ==================== الترميز ====================
+def _jsonable(obj):
+    # المجموعات تُرسل كقوائم في كل المرمّزات
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"لا يمكن ترميز {type(obj).__name__}")
+
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, default=_jsonable, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        # أعداد أكبر من 64 بت مثلاً: المكتبة القياسية تتعامل معها
+        return json.dumps(obj, default=_jsonable)
+
+
+SERIALIZERS = {"json": (json.loads, lambda obj: json.dumps(obj, default=_jsonable))}
+DECODE_ERRORS = (json.JSONDecodeError,)  # orjson.JSONDecodeError مشتقة منها
+if orjson is not None:
+    SERIALIZERS["orjson"] = (orjson.loads, _orjson_dumps)
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder(enc_hook=_jsonable)
+    SERIALIZERS["msgspec"] = (msgspec.json.Decoder().decode,
+                              lambda obj: _msgspec_encoder.encode(obj).decode("utf-8"))
+    DECODE_ERRORS += (msgspec.DecodeError,)
+
+
+def select_serializer(name=SERIALIZER):
+    """اختيار المرمّز: الأسرع المتاح عند auto، والمكتبة القياسية إن لم يتوفر المطلوب"""
+    if name == "auto":
+        name = next(candidate for candidate in ("orjson", "msgspec", "json")
+                    if candidate in SERIALIZERS)
+    elif name not in SERIALIZERS:
+        log(f"⚠️ المرمّز {name} غير متاح، سيُستخدم json", "WARNING")
+        name = "json"
+    return (name, *SERIALIZERS[name])
+
+
+# loads تقبل نصاً أو بايتات، و dumps تعيد نصاً دائماً (إطارات WebSocket النصية)
+SERIALIZER_NAME, loads, dumps = select_serializer()
+
+
+def install_event_loop(name=EVENT_LOOP):
+    """استخدام uvloop إن كان متاحاً (يُستدعى قبل asyncio.run)"""
+    if name in ("auto", "uvloop") and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return "uvloop"
+    if name == "uvloop":
+        log("⚠️ uvloop غير مثبت، ستُستخدم حلقة asyncio", "WARNING")
+    return "asyncio"
+
+
+# ==================== المقاييس ====================
+# سجل واحد يُعرض بصيغة Prometheus على /metrics ويُعاد استخدامه في GET_STATS
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """عدّاد تراكمي مع تسميات اختيارية"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] += value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + _format_labels(self.labels, labels), value
+
+    def snapshot(self):
+        if not self.labels:
+            return self.values.get((), 0)
+        return {"/".join(map(str, labels)): value for labels, value in self.values.items()}
+
+
+class Gauge(Counter):
+    """قيمة لحظية؛ إما تُضبط مباشرة أو تُقرأ من دالة عند كل عرض"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = defaultdict(float, self.collect())
+        return super().samples()
+
+    def snapshot(self):
+        if self.collect is not None:
+            self.values = defaultdict(float, self.collect())
+        return super().snapshot()
+
+
+class Histogram:
+    """مدرج تكراري تراكمي بحدود ثابتة"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield self.name + "_bucket" + _format_labels(self.labels, labels, f'le="{le}"'), cumulative
+            yield self.name + "_sum" + _format_labels(self.labels, labels), total
+            yield self.name + "_count" + _format_labels(self.labels, labels), count
+
+    def quantile(self, q, *labels):
+        """تقدير الكمية q من حدود الفئات (الحد الأعلى للفئة)"""
+        series = self.series.get(labels)
+        if not series or not series[2]:
+            return 0
+        rank = q * series[2]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (self.buckets[-1],), series[0]):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        result = {}
+        for labels, (counts, total, count) in self.series.items():
+            result["/".join(map(str, labels)) or "all"] = {
+                "count": count,
+                "avg": round(total / count, 6) if count else 0,
+                "p50": self.quantile(0.5, *labels),
+                "p99": self.quantile(0.99, *labels),
+            }
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """نص بصيغة Prometheus"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+metrics = MetricsRegistry()
+messages_total = metrics.register(Counter(
+    "relay_messages_total", "الرسائل حسب النوع والاتجاه", ("type", "direction")))
+bytes_total = metrics.register(Counter(
+    "relay_bytes_total", "البايتات حسب النوع والاتجاه", ("type", "direction")))
+relay_latency = metrics.register(Histogram(
+    "relay_latency_seconds", "من وقت المرسل حتى اكتمال الإرسال للمستقبل", ("type",)))
+fanout_size = metrics.register(Histogram(
+    "relay_fanout_size", "عدد المستقبلين لكل رسالة موزعة", ("type",), FANOUT_BUCKETS))
+handler_seconds = metrics.register(Histogram(
+    "relay_handler_seconds", "زمن تنفيذ المعالج لكل نوع", ("type",)))
+handler_errors = metrics.register(Counter(
+    "relay_handler_errors_total", "أخطاء المعالج لكل نوع", ("type",)))
+rejected_total = metrics.register(Counter(
+    "relay_rejected_total", "رسائل واردة مرفوضة حسب النوع والسبب (size / rate)", ("type", "reason")))
+throttled_seconds = metrics.register(Counter(
+    "relay_inbound_throttled_seconds_total", "زمن إبطاء القراءة بسبب ميزانية الوارد"))
+loop_lag = metrics.register(Histogram(
+    "relay_event_loop_lag_seconds", "تأخر حلقة الأحداث عن موعدها"))
+disk_write_seconds = metrics.register(Histogram(
+    "relay_disk_write_seconds", "زمن عملية القرص من الجدولة حتى الانتهاء"))
+queue_depth = metrics.register(Gauge(
+    "relay_send_queue_depth", "عمق طابور الإرسال لكل جهاز", ("device",),
+    collect=lambda: {(dev_id,): peer.depth for dev_id, peer in connected.items()}))
+dropped_total = metrics.register(Gauge(
+    "relay_dropped_frames", "الإطارات المحذوفة من الطابور لكل جهاز", ("device",),
+    collect=lambda: {(dev_id,): peer.dropped for dev_id, peer in connected.items()}))
+connected_gauge = metrics.register(Gauge(
+    "relay_connected_devices", "الأجهزة المتصلة",
+    collect=lambda: {(): len(connected)}))
+
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.25))
+
+
+def client_time(timestamp):
+    """وقت المرسل بالثواني (العملاء في المتصفح يرسلون بالمللي ثانية)"""
+    if timestamp > 1e11:
+        return timestamp / 1000
+    return timestamp
+
+
+async def monitor_event_loop():
+    """قياس تأخر حلقة الأحداث: الفرق بين موعد الاستيقاظ المتوقع والفعلي"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - expected))
+
+
+# ==================== البروتوكول الثنائي ====================
+# رسائل التحكم تبقى JSON، أما الوسائط فيمكن إرسالها كإطار ثنائي:
+#   ترويسة ثابتة (18 بايت، ترتيب الشبكة):
+#     الإصدار (B) | النوع (B) | الأعلام (B) | طول المعرف (B)
+#     طول البيانات الوصفية (H) | التسلسل (I) | الوقت (d)
+#   ثم معرف الجهاز (UTF-8) ثم بيانات وصفية JSON اختيارية ثم البيانات الخام.
+# يُفعَّل الإرسال الثنائي للعميل عند التسجيل بـ "binary": true
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("!BBBBHId")
+
+MEDIA_TYPES = {
+    "VIDEO_FRAME": 1,
+    "PHOTO": 2,
+    "AUDIO": 3,
+    "AUDIO_STREAM": 4,
+}
+MEDIA_TYPE_NAMES = {code: name for name, code in MEDIA_TYPES.items()}
+# أجزاء الرفع المجزأ تصل بالترويسة نفسها لكنها لا تُوزع على المشتركين
+MEDIA_TYPE_NAMES[5] = "UPLOAD_CHUNK"
+
+# اسم حقل البيانات في رسائل JSON القديمة (base64)
+MEDIA_PAYLOAD_FIELDS = {
+    "VIDEO_FRAME": "frame",
+    "PHOTO": "image",
+    "AUDIO": "audio",
+    "AUDIO_STREAM": "audio",
+    "UPLOAD_CHUNK": "data",
+}
+
+# حقول لا تُنقل إلى البيانات الوصفية لأنها جزء من الترويسة
+MEDIA_HEADER_FIELDS = {"type", "deviceId", "sequence", "isLast", "timestamp", "keyframe", "durable"}
+
+FLAG_LAST = 0x01
+FLAG_KEYFRAME = 0x02
+FLAG_DURABLE = 0x04  # المرسل يطلب تأكيداً بعد الكتابة الفعلية على القرص
+
+
+class ProtocolError(ValueError):
+    """إطار ثنائي غير صالح"""
+
+
+class MediaFrame:
+    """إطار وسائط واحد مع ترميزاته المخزنة (ثنائي / JSON)
+
+    تُحسب كل صيغة مرة واحدة عند الحاجة فقط، والإطار الثنائي الوارد
+    يُعاد توجيهه كما هو دون نسخ.
+    """
+
+    __slots__ = ("kind", "device_id", "sequence", "flags", "timestamp", "meta",
+                 "_payload", "_b64", "_binary", "_json")
+
+    def __init__(self, kind, device_id, sequence=0, flags=0, timestamp=None,
+                 meta=None, payload=None, b64=None, binary=None):
+        self.kind = kind
+        self.device_id = device_id
+        self.sequence = sequence
+        self.flags = flags
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.meta = meta or {}
+        self._payload = payload
+        self._b64 = b64
+        self._binary = binary
+        self._json = None
+
+    @property
+    def is_last(self):
+        return bool(self.flags & FLAG_LAST)
+
+    @property
+    def durable(self):
+        return bool(self.flags & FLAG_DURABLE)
+
+    @property
+    def payload(self):
+        """البيانات الخام (يُفك base64 عند أول طلب فقط)"""
+        if self._payload is None:
+            self._payload = base64.b64decode(self._b64 or "")
+        return self._payload
+
+    @property
+    def b64(self):
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self._payload).decode("ascii")
+        return self._b64
+
+    @property
+    def size(self):
+        """حجم البيانات الخام دون فك التشفير إن أمكن"""
+        if self._payload is not None:
+            return len(self._payload)
+        data = self._b64 or ""
+        return len(data) * 3 // 4 - data[-2:].count("=")
+
+    def to_binary(self):
+        if self._binary is None:
+            self._binary = pack_media(self)
+        return self._binary
+
+    def to_json(self):
+        if self._json is None:
+            message = {
+                "type": self.kind,
+                "deviceId": self.device_id,
+                MEDIA_PAYLOAD_FIELDS[self.kind]: self.b64,
+                "sequence": self.sequence,
+                "isLast": self.is_last,
+                "timestamp": self.timestamp,
+            }
+            if self.flags & FLAG_KEYFRAME:
+                message["keyframe"] = True
+            message.update(self.meta)
+            self._json = dumps(message)
+        return self._json
+
+    def encoded(self, binary):
+        """الصيغة المناسبة للمستقبل؛ JSON إن لم تتسع الترويسة الثنائية للإطار"""
+        if binary:
+            try:
+                return self.to_binary()
+            except ProtocolError:
+                pass
+        return self.to_json()
+
+    def shrink(self):
+        """إسقاط الصيغ الوسيطة التي يمكن إعادة بنائها من ترميز محفوظ"""
+        if self._binary is not None:
+            self._payload = memoryview(self._binary)[len(self._binary) - self.size:]
+            self._b64 = None
+        elif self._b64 is not None:
+            self._payload = None
+
+    def footprint(self):
+        """البايتات التي تحتجزها الصيغ المبنية حالياً، مع تقدير ثابت للكائن"""
+        held = [self._binary, self._json, self._b64]
+        if self._binary is None and self._payload is not None:
+            # memoryview يبقي الرسالة الأصلية كاملة في الذاكرة
+            payload = self._payload
+            held.append(payload.obj if isinstance(payload, memoryview) else payload)
+        return 256 + sum(len(data) for data in held if data is not None)
+
+    def compact(self):
+        """نسخة بالصيغ المتوفرة فقط دون بناء جديد (لا فك base64 ولا تغليف ثنائي)"""
+        frame = MediaFrame(self.kind, self.device_id, self.sequence, self.flags, self.timestamp,
+                           self.meta, payload=self._payload, b64=self._b64, binary=self._binary)
+        frame._json = self._json
+        frame.shrink()
+        return frame
+
+
+def pack_media(frame):
+    """بناء إطار ثنائي من MediaFrame"""
+    device_bytes = frame.device_id.encode("utf-8")
+    meta_bytes = dumps(frame.meta).encode("utf-8") if frame.meta else b""
+    if len(device_bytes) > 255 or len(meta_bytes) > 0xFFFF:
+        raise ProtocolError("معرف الجهاز أو البيانات الوصفية طويلة جداً")
+    header = BINARY_HEADER.pack(
+        BINARY_VERSION,
+        MEDIA_TYPES[frame.kind],
+        frame.flags & 0xFF,
+        len(device_bytes),
+        len(meta_bytes),
+        frame.sequence & 0xFFFFFFFF,
+        float(frame.timestamp),
+    )
+    return b"".join((header, device_bytes, meta_bytes, frame.payload))
+
+
+def unpack_media(data):
+    """تحليل إطار ثنائي وارد؛ البيانات تبقى memoryview على الرسالة الأصلية"""
+    if len(data) < BINARY_HEADER.size:
+        raise ProtocolError("إطار ثنائي قصير")
+    version, type_code, flags, id_len, meta_len, sequence, timestamp = BINARY_HEADER.unpack_from(data)
+    if version != BINARY_VERSION:
+        raise ProtocolError(f"إصدار غير مدعوم: {version}")
+    kind = MEDIA_TYPE_NAMES.get(type_code)
+    if kind is None:
+        raise ProtocolError(f"نوع غير معروف: {type_code}")
+    offset = BINARY_HEADER.size
+    end = offset + id_len + meta_len
+    if len(data) < end:
+        raise ProtocolError("ترويسة مقطوعة")
+    device_id = bytes(data[offset:offset + id_len]).decode("utf-8")
+    meta = loads(bytes(data[offset + id_len:end])) if meta_len else {}
+    if not isinstance(meta, dict):
+        raise ProtocolError("البيانات الوصفية ليست كائن JSON")
+    return MediaFrame(kind, device_id, sequence, flags, timestamp, media_meta(kind, meta),
+                      payload=memoryview(data)[end:], binary=data)
+
+
+def media_meta(kind, fields):
+    """البيانات الوصفية دون حقول الترويسة والبيانات، فلا يتجاوز العميل بها النوع أو المصدر"""
+    payload_field = MEDIA_PAYLOAD_FIELDS[kind]
+    return {k: v for k, v in fields.items()
+            if k not in MEDIA_HEADER_FIELDS and k != payload_field}
+
+
+def media_from_json(data, device_id):
+    """تحويل رسالة وسائط JSON قديمة إلى MediaFrame دون فك base64"""
+    kind = data['type']
+    payload_field = MEDIA_PAYLOAD_FIELDS[kind]
+    flags = FLAG_LAST if data.get('isLast', False) else 0
+    if data.get('keyframe'):
+        flags |= FLAG_KEYFRAME
+    if data.get('durable'):
+        flags |= FLAG_DURABLE
+    return MediaFrame(kind, device_id, data.get('sequence', 0), flags,
+                      data.get('timestamp'), media_meta(kind, data), b64=data.get(payload_field, ''))
+
+
+def rebind_media(frame, device_id):
+    """فرض معرف الجهاز المسجل على إطار ثنائي يحمل معرفاً آخر"""
+    return MediaFrame(frame.kind, device_id, frame.sequence, frame.flags,
+                      frame.timestamp, frame.meta, payload=frame.payload)
+
+
+# ==================== حدود الوارد ====================
+class TokenBucket:
+    """دلو رموز بالبايت: يُملأ بمعدل ثابت حتى سعته، والرسالة الأكبر من الرصيد
+    تنتظر حتى يتوفر (رصيد سالب = دين يُسدَّد من الرسائل التالية)"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount, max_delay):
+        """خصم amount؛ يعيد مدة الانتظار المطلوبة، أو None إن تجاوزت max_delay"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = (amount - self.tokens) / self.rate if amount > self.tokens else 0.0
+        if delay > max_delay:
+            return None
+        self.tokens -= amount
+        return delay
+
+
+TYPE_PREFIX = re.compile(r'"type"\s*:\s*"(\w+)"')
+
+
+def sniff_type(text):
+    """نوع رسالة JSON من أول 256 حرفاً دون تحليلها، أو UNKNOWN إن لم يظهر فيها نوع معروف"""
+    match = TYPE_PREFIX.search(text, 0, 256)
+    return match.group(1) if match and match.group(1) in HANDLERS else "UNKNOWN"
+
+
+def inbound_kind(message):
+    """نوع الرسالة قبل تحليلها: من ترويسة الإطار الثنائي أو بداية نص JSON"""
+    if isinstance(message, bytes):
+        return MEDIA_TYPE_NAMES.get(message[1], "UNKNOWN") if len(message) > 1 else "UNKNOWN"
+    return sniff_type(message)
+
+
+def wire_size(message):
+    """حجم الرسالة بالبايت كما وصلت؛ النص غير ASCII وحده يُرمَّز لعدّه"""
+    if isinstance(message, bytes) or message.isascii():
+        return len(message)
+    return len(message.encode("utf-8"))
+
+
+def size_limit(msg_type):
+    return SIZE_LIMITS.get(msg_type, CONTROL_MAX_SIZE)
+
+
+def reject_inbound(peer, msg_type, reason, size):
+    """رفض رسالة واردة؛ الوسائط المباشرة تُحذف بصمت وغيرها يُبلَّغ مرسلها"""
+    rejected_total.inc(msg_type, reason)
+    log(f"⛔ رفض رسالة {msg_type} ({reason}) - {format_size(size)}", "LIMIT", device=peer.device_id)
+    if msg_type in LIVE_TYPES:
+        return
+    if reason == "size":
+        send_error(peer, f"الرسالة أكبر من الحد المسموح لـ {msg_type}",
+                   reason=reason, limit=size_limit(msg_type))
+    else:
+        send_error(peer, "تجاوز حد معدل الإرسال، أعد المحاولة لاحقاً",
+                   reason=reason, retryAfter=INBOUND_MAX_DELAY)
+
+
+# ==================== طوابير الإرسال ====================
+class Peer:
+    """اتصال واحد مع طابور إرسال محدود ومهمة كتابة خاصة به
+
+    رسائل التحكم (COMMAND، REGISTERED، الردود...) لا تُحذف أبداً، أما
+    الوسائط المباشرة فيُحذف أقدمها عند امتلاء الطابور، والصور والتسجيلات
+    الموزعة لها طابور محدود بالبايت، حتى لا يبطئ اتصال ضعيف المرسل أو
+    يستهلك ذاكرة السيرفر.
+    """
+
+    __slots__ = ("ws", "device_id", "binary", "zstd", "deflate", "control", "media", "media_bytes",
+                 "live", "dropped", "closed", "seen", "budget", "_wakeup", "_writer")
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.device_id = None
+        self.binary = False
+        self.zstd = False
+        self.deflate = next((extension for extension in getattr(ws, "extensions", ())
+                             if isinstance(extension, PayloadAwareDeflate)), None)
+        self.control = deque()
+        self.media = deque()
+        self.media_bytes = 0
+        self.live = deque()
+        self.dropped = 0
+        self.closed = False
+        self.seen = timer_wheel.now  # آخر نشاط بدقة نبضة العجلة
+        self.budget = TokenBucket(INBOUND_RATE, INBOUND_BURST) if INBOUND_RATE > 0 else None
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def depth(self):
+        return len(self.control) + len(self.media) + len(self.live)
+
+    def send(self, payload, live=False, kind="CONTROL", origin=None):
+        """إضافة رسالة مُرمَّزة إلى الطابور؛ يعيد False إن كان الاتصال مغلقاً
+
+        kind و origin (وقت المرسل) يُستخدمان للمقاييس بعد اكتمال الإرسال.
+        """
+        if self.closed:
+            return False
+        item = (payload, kind, origin)
+        if live:
+            if len(self.live) >= SEND_QUEUE_SIZE:
+                self.live.popleft()
+                self.dropped += 1
+                stats['dropped_frames'] += 1
+            self.live.append(item)
+        elif kind in MEDIA_TYPES:
+            self.media.append(item)
+            self.media_bytes += len(payload)
+            while self.media_bytes > MEDIA_QUEUE_BYTES and len(self.media) > 1:
+                self.media_bytes -= len(self.media.popleft()[0])
+                self.dropped += 1
+                stats['dropped_frames'] += 1
+        else:
+            self.control.append(item)
+        self._wakeup.set()
+        return True
+
+    def send_json(self, message):
+        kind = message.get("type", "CONTROL")
+        text = dumps(message)
+        if self.zstd and kind in ZSTD_TYPES and len(text) >= ZSTD_MIN_SIZE:
+            return self.send(zstd_compress(text), kind=kind)
+        return self.send(text, kind=kind)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.control or self.media or self.live:
+                    queue = self.control or self.media or self.live
+                    payload, kind, origin = queue.popleft()
+                    if queue is self.media:
+                        self.media_bytes -= len(payload)
+                    if self.deflate is not None:
+                        # الترميز يحدث داخل send قبل أول انتظار، فالعلامة تخص هذه الرسالة فقط
+                        self.deflate.skip = kind in MEDIA_TYPES
+                    await self.ws.send(payload)
+                    messages_total.inc(kind, "out")
+                    bytes_total.inc(kind, "out", value=len(payload))
+                    if origin is not None:
+                        latency = time.time() - client_time(origin)
+                        if 0 <= latency < 3600:
+                            relay_latency.observe(latency, kind)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            log(f"❌ خطأ في الإرسال إلى {self.device_id}: {e!r}", "ERROR")
+            await self.ws.close(1011)
+        finally:
+            self.closed = True
+            self.control.clear()
+            self.media.clear()
+            self.media_bytes = 0
+            self.live.clear()
+
+    async def flush(self, timeout):
+        """انتظار إرسال ما في الطابور (قبل إغلاق الاتصال عند الإيقاف)"""
+        deadline = time.monotonic() + timeout
+        while self.depth and not self.closed and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    def close(self):
+        self.closed = True
+        self._writer.cancel()
+
+
+def queue_stats():
+    """عمق الطابور وعدد الإطارات المحذوفة لكل جهاز"""
+    return {
+        dev_id: {"depth": peer.depth, "dropped": peer.dropped}
+        for dev_id, peer in connected.items()
+    }
+
+
+# ==================== ضغط الرسائل ====================
+class PayloadAwareDeflate(PerMessageDeflate):
+    """permessage-deflate يتخطى ما لا يستفيد من الضغط
+
+    الإطارات الثنائية والوسائط (JPEG/فيديو مضغوطة أصلاً) والرسائل الصغيرة
+    تُرسل دون ضغط (RSV1 غير مفعّل)، وهذا مسموح لكل رسالة على حدة.
+    """
+
+    skip = False
+    _skipping = False
+
+    def encode(self, frame):
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not frames.OP_CONT:
+            self._skipping = (self.skip or frame.opcode is frames.OP_BINARY
+                              or len(frame.data) < DEFLATE_MIN_SIZE)
+        if self._skipping:
+            return frame
+        return super().encode(frame)
+
+
+class PayloadAwareDeflateFactory(ServerPerMessageDeflateFactory):
+    """تفاوض permessage-deflate عادي، مع امتداد يتخطى الوسائط"""
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, PayloadAwareDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+        )
+
+
+def server_extensions(compression=COMPRESSION):
+    """امتدادات الضغط المعروضة على العملاء حسب COMPRESSION"""
+    if compression != "deflate":
+        return []
+    return [PayloadAwareDeflateFactory(
+        server_max_window_bits=DEFLATE_WINDOW_BITS,
+        client_max_window_bits=DEFLATE_WINDOW_BITS,
+        compress_settings={"memLevel": DEFLATE_MEM_LEVEL, "level": DEFLATE_LEVEL},
+    )]
+
+
+_zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard else None
+
+
+def zstd_compress(text):
+    """رسالة تحكم مضغوطة بـ zstd تُرسل كإطار ثنائي (يبدأ بالرقم السحري 28 B5 2F FD)"""
+    return _zstd.compress(text.encode("utf-8"))
+
+
+# ==================== التوزيع (Fan-out) ====================
+def encoder_for(message):
+    """دالة ترميز تُسلسل الرسالة مرة واحدة فقط مهما كان عدد المستقبلين"""
+    if isinstance(message, MediaFrame):
+        return lambda peer: message.encoded(peer.binary)
+    text = dumps(message)
+    if message.get("type") not in ZSTD_TYPES or len(text) < ZSTD_MIN_SIZE:
+        return lambda peer: text
+    
+    packed = []
+    
+    def encode(peer):
+        if not peer.zstd:
+            return text
+        if not packed:
+            packed.append(zstd_compress(text))
+        return packed[0]
+    return encode
+
+
+def fan_out(message, recipients):
+    """توزيع رسالة على طوابير عدة أجهزة
+
+    recipients: قائمة (معرف الجهاز، Peer).
+    يعيد (عدد الناجحين، {معرف الجهاز: السبب} للفاشلين).
+    """
+    encode = encoder_for(message)
+    if isinstance(message, MediaFrame):
+        kind, origin = message.kind, message.timestamp
+    else:
+        kind, origin = message.get("type", "CONTROL"), None
+    live = kind in LIVE_TYPES
+    fanout_size.observe(len(recipients), kind)
+    
+    sent = 0
+    failed = {}
+    for dev_id, peer in recipients:
+        if peer.send(encode(peer), live=live, kind=kind, origin=origin):
+            sent += 1
+        else:
+            failed[dev_id] = "closed"
+    
+    return sent, failed
+
+
+def broadcast_to_all(message, exclude=None):
+    """بث رسالة لجميع الأجهزة ما عدا المستبعد"""
+    recipients = [(dev_id, peer) for dev_id, peer in connected.items()
+                  if not (exclude and dev_id == exclude)]
+    sent, _ = fan_out(message, recipients)
+    return sent
+
+
+# ==================== الاشتراكات والتوجيه ====================
+ALL_SOURCES = "*"
+subscriptions = defaultdict(dict)  # {kind: {source_id: {subscriber_id}}}
+subscriber_index = defaultdict(set)  # {subscriber_id: {(kind, source_id)}}
+
+
+def subscribe(subscriber_id, source_id, kinds):
+    """اشتراك جهاز في أنواع وسائط مصدر معين (أو جميع المصادر بـ "*")"""
+    for kind in kinds:
+        subscriptions[kind].setdefault(source_id, set()).add(subscriber_id)
+        subscriber_index[subscriber_id].add((kind, source_id))
+    cluster.watch_source(source_id)
+
+
+def unsubscribe(subscriber_id, source_id=None, kinds=None):
+    """إلغاء الاشتراك؛ بدون مصدر أو أنواع يُلغى كل ما يطابق"""
+    for kind, source in list(subscriber_index.get(subscriber_id, ())):
+        if source_id is not None and source != source_id:
+            continue
+        if kinds is not None and kind not in kinds:
+            continue
+        by_source = subscriptions[kind]
+        by_source[source].discard(subscriber_id)
+        if not by_source[source]:
+            del by_source[source]
+        subscriber_index[subscriber_id].discard((kind, source))
+    if not subscriber_index.get(subscriber_id):
+        subscriber_index.pop(subscriber_id, None)
+
+
+def subscribe_by_capabilities(device_id, capabilities):
+    """اشتراك تلقائي لأجهزة العرض حسب الإمكانيات المعلنة في device_info"""
+    if VIEWER_CAPABILITIES.intersection(capabilities):
+        subscribe(device_id, ALL_SOURCES, MEDIA_TYPES)
+        return True
+    return False
+
+
+def media_recipients(frame):
+    """المشتركون المتصلون في وسائط هذا المصدر ونوعه"""
+    source = frame.device_id
+    by_source = subscriptions.get(frame.kind, {})
+    direct = by_source.get(source)
+    wildcard = by_source.get(ALL_SOURCES)
+    if direct and wildcard:
+        ids = direct | wildcard
+    else:
+        ids = direct or wildcard or ()
+    
+    recipients = []
+    for dev_id in ids:
+        peer = connected.get(dev_id)
+        if peer is not None and dev_id != source:
+            recipients.append((dev_id, peer))
+    
+    if MEDIA_BROADCAST_FALLBACK:
+        recipients.extend(
+            (dev_id, peer) for dev_id, peer in connected.items()
+            if dev_id != source and dev_id not in subscriber_index
+        )
+    return recipients
+
+
+def route_media(frame):
+    """إعادة توجيه إطار وسائط إلى مشتركيه فقط؛ يعيد عدد المستقبلين المحليين"""
+    sent, _ = fan_out(frame, media_recipients(frame))
+    catchup_cache.store(frame, viewed=sent > 0)
+    cluster.publish_media(frame)
+    return sent
+
+
+# ==================== ذاكرة اللحاق ====================
+class CatchupCache:
+    """آخر إطارات كل مصدر لإرسالها فوراً لمن يشترك متأخراً
+
+    الإطارات تُحفظ بالصيغ التي وصلت بها (MediaFrame.compact)، والصيغة الأخرى
+    تُبنى عند الإعادة فقط، والحد يُحسب من الصيغ المحفوظة فعلاً. لكل مصدر حلقة
+    من آخر CATCHUP_FRAMES إطار فيديو تبدأ من آخر إطار مفتاحي، مع آخر صورة. عند تجاوز CATCHUP_MAX_BYTES يُحذف أولاً المصدر
+    الذي لم يُشاهَد منذ أطول مدة.
+    """
+
+    def __init__(self, max_frames=CATCHUP_FRAMES, max_bytes=CATCHUP_MAX_BYTES):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.sources = OrderedDict()  # {source: {"frames", "photo", "bytes"}} الأقدم مشاهدة أولاً
+        self.bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def cost(frame):
+        return frame.footprint()
+
+    def _charge(self, entry, amount):
+        entry["bytes"] += amount
+        self.bytes += amount
+
+    def store(self, frame, viewed=False):
+        if self.max_bytes <= 0 or frame.kind not in CATCHUP_KINDS:
+            return
+        frame = frame.compact()
+        entry = self.sources.get(frame.device_id)
+        if entry is None:
+            entry = self.sources[frame.device_id] = {"frames": deque(), "photo": None, "bytes": 0}
+        elif viewed:
+            self.sources.move_to_end(frame.device_id)
+        
+        if frame.kind == "PHOTO":
+            if entry["photo"] is not None:
+                self._charge(entry, -self.cost(entry["photo"]))
+            entry["photo"] = frame
+        else:
+            frames = entry["frames"]
+            if frame.flags & FLAG_KEYFRAME:
+                # ما قبل الإطار المفتاحي لا يفيد المشاهد الجديد
+                while frames:
+                    self._charge(entry, -self.cost(frames.popleft()))
+            elif len(frames) >= self.max_frames:
+                self._charge(entry, -self.cost(frames.popleft()))
+            frames.append(frame)
+        self._charge(entry, self.cost(frame))
+        self._evict(keep=frame.device_id)
+
+    def _evict(self, keep):
+        while self.bytes > self.max_bytes:
+            source = next(iter(self.sources))
+            if source != keep:
+                self.forget(source)
+                self.evictions += 1
+            elif len(self.sources) > 1:
+                self.sources.move_to_end(source)
+            elif self.sources[source]["frames"]:
+                entry = self.sources[source]
+                self._charge(entry, -self.cost(entry["frames"].popleft()))
+            else:
+                break
+
+    def forget(self, source):
+        entry = self.sources.pop(source, None)
+        if entry is not None:
+            self.bytes -= entry["bytes"]
+
+    def replay(self, peer, source_id, kinds):
+        """إرسال المحفوظ لمشترك جديد دون تجاوز طابور الوسائط المباشرة؛ يعيد عدد الإطارات"""
+        if source_id == ALL_SOURCES:
+            sources = list(reversed(self.sources))  # الأحدث مشاهدة أولاً
+        else:
+            sources = [source_id]
+        budget = SEND_QUEUE_SIZE
+        replayed = 0
+        for source in sources:
+            entry = self.sources.get(source)
+            if entry is None or source == peer.device_id:
+                continue
+            frames = []
+            if "PHOTO" in kinds and entry["photo"] is not None:
+                frames.append(entry["photo"])
+            if "VIDEO_FRAME" in kinds:
+                frames.extend(entry["frames"])
+            if not frames or len(frames) > budget:
+                continue
+            for frame in frames:
+                charged = self.cost(frame)
+                peer.send(frame.encoded(peer.binary), live=frame.kind in LIVE_TYPES, kind=frame.kind)
+                # الصيغة المبنية للمشترك تبقى لمن يليه، ويُحسب حجمها الآن
+                frame.shrink()
+                self._charge(entry, self.cost(frame) - charged)
+            budget -= len(frames)
+            replayed += len(frames)
+            self.sources.move_to_end(source)
+        if replayed:
+            self._evict(keep=next(reversed(self.sources)))
+        return replayed
+
+    def stats(self):
+        return {
+            "sources": len(self.sources),
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+        }
+
+
+catchup_cache = CatchupCache()
+
+
+# ==================== الحضور: تحديثات تدريجية ====================
+def device_entry(device_id):
+    """وصف الجهاز كما يظهر في القائمة وفي أحداث الحضور"""
+    if device_id in connected:
+        info = presence_info(device_id)
+    else:
+        info = cluster.remote_devices[device_id]["info"]
+    return {"id": device_id, **info, "status": "online"}
+
+
+class Presence:
+    """أحداث الحضور المرقمة بدل إعادة بث القائمة كاملة
+
+    كل انضمام أو مغادرة أو تحديث يأخذ رقم إصدار متزايداً ويُحفظ في سجل
+    محدود، وتُجمع أحداث النافذة القصيرة في رسالة واحدة. العميل يتجاهل
+    الأحداث الأقدم من نسخته، وإن وجد فجوة يطلب GET_DEVICES مع knownVersion
+    فيصله ما فاته من السجل أو لقطة كاملة إن لم يعد السجل يغطيه.
+    """
+
+    def __init__(self, log_size=PRESENCE_LOG_SIZE, coalesce=PRESENCE_COALESCE):
+        self.epoch = f"{WORKER_ID}:{int(time.time())}"
+        self.version = 0
+        self.history = deque(maxlen=log_size)
+        self.coalesce = coalesce
+        self.pending = []
+        self.flush_handle = None
+
+    def record(self, event_type, device_id):
+        """تسجيل حدث حضور وجدولة بثه مع بقية أحداث النافذة"""
+        self.version += 1
+        event = {"type": event_type, "version": self.version, "deviceId": device_id}
+        if event_type != "DEVICE_LEFT":
+            event["device"] = device_entry(device_id)
+        self.history.append(event)
+        self.pending.append(event)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.coalesce, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        events, self.pending = self.pending, []
+        if len(events) == 1:
+            broadcast_to_all({**events[0], "epoch": self.epoch, "timestamp": time.time()})
+        elif events:
+            broadcast_to_all(self.batch(events))
+
+    def batch(self, events):
+        return {
+            "type": "PRESENCE_BATCH",
+            "epoch": self.epoch,
+            "events": events,
+            "version": self.version,
+            "timestamp": time.time()
+        }
+
+    def since(self, version):
+        """الأحداث بعد version، أو None إن لم يعد السجل يغطيها"""
+        if version == self.version:
+            return []
+        if version > self.version or not self.history or self.history[0]["version"] > version + 1:
+            return None
+        return [event for event in self.history if event["version"] > version]
+
+    def send_state(self, peer, known_version=None, epoch=None):
+        """إرسال ما فات العميل إن أمكن، وإلا لقطة كاملة"""
+        missed = None
+        if known_version is not None and epoch == self.epoch:
+            missed = self.since(int(known_version))
+        if missed is None:
+            send_device_list(peer)
+        else:
+            peer.send_json(self.batch(missed))
+
+
+def send_device_list(target):
+    """إرسال لقطة كاملة لقائمة الأجهزة مع رقم الإصدار"""
+    devices_list = [device_entry(dev_id) for dev_id in connected]
+    devices_list.extend(device_entry(dev_id) for dev_id in cluster.remote_devices
+                        if dev_id not in connected)
+    
+    target.send_json({
+        "type": "DEVICE_LIST",
+        "devices": devices_list,
+        "count": len(devices_list),
+        "epoch": presence.epoch,
+        "version": presence.version,
+        "timestamp": time.time()
+    })
+
+
+presence = Presence()
+
+
+# ==================== نبض الحضور ====================
+class TimerWheel:
+    """عجلة مؤقتات مُجزأة: إضافة وإلغاء بتكلفة ثابتة ودقة نبضة واحدة
+
+    المؤقت يوضع في خانة موعده، ولكل نبضة تُفحص خانة واحدة فقط. المواعيد
+    الأبعد من دورة كاملة تبقى في خانتها حتى يحين موعدها.
+    """
+
+    def __init__(self, tick=TIMER_TICK, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.timers = {}  # {key: رقم الخانة}
+        self.now = 0
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay, callback):
+        """جدولة callback(key) بعد delay ثانية (تستبدل أي مؤقت سابق بنفس المفتاح)"""
+        self.cancel(key)
+        deadline = self.now + max(1, -int(-delay // self.tick))
+        slot = deadline % len(self.slots)
+        self.slots[slot][key] = (deadline, callback)
+        self.timers[key] = slot
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self):
+        self.now += 1
+        bucket = self.slots[self.now % len(self.slots)]
+        due = [(key, callback) for key, (deadline, callback) in bucket.items()
+               if deadline <= self.now]
+        for key, callback in due:
+            del bucket[key]
+            del self.timers[key]
+            try:
+                callback(key)
+            except Exception as e:
+                log(f"❌ خطأ في مؤقت {key!r}: {e!r}", "ERROR")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            await asyncio.sleep(self.tick)
+            # تدارك النبضات الفائتة إن تأخرت الحلقة
+            while self.now < int((loop.time() - started) / self.tick):
+                self.advance()
+
+
+timer_wheel = TimerWheel()
+
+
+def watch_peer(peer, delay=PRESENCE_TIMEOUT):
+    timer_wheel.schedule(peer, delay, check_peer)
+
+
+def check_peer(peer):
+    """موعد فحص الاتصال: إن كان نشطاً يُؤجل، وإلا يُختبر بـ ping"""
+    if peer.closed:
+        return
+    idle = (timer_wheel.now - peer.seen) * timer_wheel.tick
+    if idle < PRESENCE_TIMEOUT:
+        if peer.device_id in device_info:
+            device_info[peer.device_id]['last_seen'] = time.time() - idle
+        watch_peer(peer, PRESENCE_TIMEOUT - idle)
+    else:
+        asyncio.create_task(probe_peer(peer))
+
+
+async def probe_peer(peer):
+    try:
+        pong = await peer.ws.ping()
+        await asyncio.wait_for(pong, PRESENCE_PROBE_TIMEOUT)
+    except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+        log(f"💤 اتصال صامت لا يستجيب: {peer.device_id}", "EXPIRE", device=peer.device_id)
+        # الإزالة فوراً حتى لا تُرسل إليه رسائل جديدة، ثم الإغلاق دون انتظار المعالج
+        drop_peer(peer)
+        await peer.ws.close(1001, "presence timeout")
+    else:
+        peer.seen = timer_wheel.now
+        watch_peer(peer)
+
+
+def drop_peer(peer):
+    """إزالة اتصال من الأجهزة المتصلة وبث مغادرته (مرة واحدة فقط)"""
+    peer.close()
+    timer_wheel.cancel(peer)
+    device_id = peer.device_id
+    if not device_id or connected.get(device_id) is not peer:
+        return
+    del connected[device_id]
+    if device_id in device_info:
+        device_info[device_id]['last_seen'] = time.time()
+        went_offline(device_id)
+    catchup_cache.forget(device_id)
+    
+    forget_log_samples(device_id)
+    cluster.device_left(device_id)
+    log(f"📊 الأجهزة المتبقية: {len(connected)}", "CLEAN", device=device_id)
+    
+    # الجهاز قد يكون انتقل لعامل آخر قبل أن يُغلق اتصاله هنا
+    if device_id not in cluster.remote_devices:
+        presence.record("DEVICE_LEFT", device_id)
+
+
+def went_offline(device_id):
+    offline_devices[device_id] = time.time()
+    offline_devices.move_to_end(device_id)
+    timer_wheel.schedule(("offline", device_id), OFFLINE_DEVICE_TTL, evict_device)
+    while len(offline_devices) > OFFLINE_DEVICE_LIMIT:
+        evict_device(("offline", next(iter(offline_devices))))
+
+
+def came_online(device_id):
+    if offline_devices.pop(device_id, None) is not None:
+        timer_wheel.cancel(("offline", device_id))
+
+
+def evict_device(key):
+    """نسيان جهاز غير متصل: معلوماته واشتراكاته وطلب تسجيله"""
+    device_id = key[1]
+    timer_wheel.cancel(key)
+    if offline_devices.pop(device_id, None) is None or device_id in connected:
+        return
+    device_info.pop(device_id, None)
+    unsubscribe(device_id)
+    recording_sources.discard(device_id)
+    log(f"🧹 حذف معلومات جهاز غير متصل: {device_id}", "EXPIRE", device=device_id)
+
+
+# ==================== الناقل المشترك بين العمليات ====================
+def channel_matches(pattern, channel):
+    """مطابقة قناة مع نمط (النجمة في النهاية فقط)"""
+    if pattern.endswith("*"):
+        return channel.startswith(pattern[:-1])
+    return pattern == channel
+
+
+class LocalBus:
+    """ناقل داخل العملية نفسها: الافتراضي للعامل الواحد وللاختبارات
+
+    كل الناقلات: start / subscribe غير متزامنة، أما publish فتكتب في
+    المخزن فوراً دون انتظار حتى لا يبطئ النشر مسار الرسائل.
+    """
+
+    subscribers = defaultdict(set)  # مشترك بين كل النسخ في العملية
+
+    def __init__(self):
+        self.callback = None
+        self.patterns = set()
+
+    async def start(self, callback):
+        self.callback = callback
+
+    async def subscribe(self, channel):
+        self.patterns.add(channel)
+        LocalBus.subscribers[channel].add(self)
+
+    def publish(self, channel, payload):
+        loop = asyncio.get_running_loop()
+        for pattern, buses in list(LocalBus.subscribers.items()):
+            if channel_matches(pattern, channel):
+                for bus in list(buses):
+                    loop.call_soon(bus.callback, channel, payload)
+
+    async def close(self):
+        for pattern in self.patterns:
+            LocalBus.subscribers[pattern].discard(self)
+
+
+# إطار الموزع المحلي: الطول، العملية، طول القناة؛ ثم القناة ثم البيانات
+HUB_FRAME = struct.Struct("!IBH")
+HUB_SUBSCRIBE, HUB_PUBLISH, HUB_MESSAGE = 1, 2, 3
+HUB_MAX_BUFFER = int(os.environ.get("HUB_MAX_BUFFER", 8 * 1024 * 1024))
+
+
+def pack_hub_frame(op, channel, payload=b""):
+    channel_bytes = channel.encode("utf-8")
+    return b"".join((
+        HUB_FRAME.pack(HUB_FRAME.size - 4 + len(channel_bytes) + len(payload), op, len(channel_bytes)),
+        channel_bytes,
+        payload,
+    ))
+
+
+async def read_hub_frame(reader):
+    header = await reader.readexactly(HUB_FRAME.size)
+    length, op, channel_len = HUB_FRAME.unpack(header)
+    body = await reader.readexactly(length - (HUB_FRAME.size - 4))
+    return op, body[:channel_len].decode("utf-8"), body[channel_len:]
+
+
+class BusHub:
+    """موزع رسائل بسيط على مقبس unix تشغله العملية الرئيسية لعمالها"""
+
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = defaultdict(set)  # {النمط: {writer}}
+        self.clients = set()
+        self.dropped = 0
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._client, self.path)
+
+    async def _client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                op, channel, payload = await read_hub_frame(reader)
+                if op == HUB_SUBSCRIBE:
+                    self.subscribers[channel].add(writer)
+                elif op == HUB_PUBLISH:
+                    self._forward(channel, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            for writers in self.subscribers.values():
+                writers.discard(writer)
+            writer.close()
+
+    def _forward(self, channel, payload):
+        frame = None
+        for pattern, writers in self.subscribers.items():
+            if not channel_matches(pattern, channel):
+                continue
+            frame = frame or pack_hub_frame(HUB_MESSAGE, channel, payload)
+            for writer in writers:
+                # مشترك بطيء: نحذف بدل أن نملأ الذاكرة
+                if writer.transport.get_write_buffer_size() > HUB_MAX_BUFFER:
+                    self.dropped += 1
+                    continue
+                writer.write(frame)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            # إغلاق العملاء ليُنهي كل منهم حلقته بقراءة EOF بدل الإلغاء
+            for writer in list(self.clients):
+                writer.close()
+            for _ in range(100):
+                if not self.clients:
+                    break
+                await asyncio.sleep(0.01)
+            await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class HubBus:
+    """عميل الموزع المحلي (unix:///path)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    async def start(self, callback):
+        for attempt in range(50):
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"تعذر الاتصال بالموزع: {self.path}")
+        self.task = asyncio.create_task(self._read_loop(callback))
+
+    async def _read_loop(self, callback):
+        try:
+            while True:
+                op, channel, payload = await read_hub_frame(self.reader)
+                if op == HUB_MESSAGE:
+                    callback(channel, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log("🔴 انقطع الاتصال بالموزع", "ERROR")
+
+    async def subscribe(self, channel):
+        self.writer.write(pack_hub_frame(HUB_SUBSCRIBE, channel))
+        await self.writer.drain()
+
+    def publish(self, channel, payload):
+        self.writer.write(pack_hub_frame(HUB_PUBLISH, channel, payload))
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+def encode_resp(*args):
+    """ترميز أمر Redis (RESP)"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_resp(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("أُغلق اتصال Redis")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    if prefix == b"-":
+        raise ConnectionError(f"Redis: {rest.decode()}")
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b"*":
+        return [await read_resp(reader) for _ in range(int(rest))]
+    raise ConnectionError(f"رد Redis غير متوقع: {line!r}")
+
+
+class RedisBus:
+    """ناقل Redis Pub/Sub بدون مكتبات إضافية (redis://[:password@]host:port)
+
+    يكفي أي خادم يتكلم RESP ويدعم PUBLISH / SUBSCRIBE / PSUBSCRIBE.
+    """
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.pub = None
+        self.sub = None
+        self.tasks = []
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_resp("AUTH", self.password))
+            await read_resp(reader)
+        return reader, writer
+
+    async def start(self, callback):
+        self.pub = await self._connect()
+        self.sub = await self._connect()
+        self.tasks = [
+            asyncio.create_task(self._read_messages(callback)),
+            asyncio.create_task(self._discard_replies()),
+        ]
+
+    async def _read_messages(self, callback):
+        reader = self.sub[0]
+        try:
+            while True:
+                reply = await read_resp(reader)
+                if reply[0] == b"message":
+                    callback(reply[1].decode("utf-8"), reply[2])
+                elif reply[0] == b"pmessage":
+                    callback(reply[2].decode("utf-8"), reply[3])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log(f"🔴 انقطع الاتصال بـ Redis: {e}", "ERROR")
+
+    async def _discard_replies(self):
+        # ردود PUBLISH تُقرأ في الخلفية حتى لا ينتظر كل نشر رحلة كاملة
+        reader = self.pub[0]
+        try:
+            while True:
+                await read_resp(reader)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log(f"🔴 انقطع اتصال النشر بـ Redis: {e}", "ERROR")
+
+    async def subscribe(self, channel):
+        command = "PSUBSCRIBE" if "*" in channel else "SUBSCRIBE"
+        self.sub[1].write(encode_resp(command, channel))
+        await self.sub[1].drain()
+
+    def publish(self, channel, payload):
+        self.pub[1].write(encode_resp("PUBLISH", channel, payload))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for conn in (self.pub, self.sub):
+            if conn:
+                conn[1].close()
+
+
+def create_bus(url):
+    if not url:
+        return LocalBus()
+    if url.startswith("unix://"):
+        return HubBus(url[len("unix://"):])
+    if url.startswith("redis://"):
+        return RedisBus(url)
+    raise ValueError(f"عنوان ناقل غير مدعوم: {url}")
+
+
+# ==================== العنقود: سجل الأجهزة المشترك ====================
+# مغلف الناقل: نوع (B) وطول معرف العامل (B) ثم المعرف ثم المحتوى
+ENVELOPE = struct.Struct("!BB")
+ENVELOPE_JSON, ENVELOPE_MEDIA = 1, 2
+
+
+class Cluster:
+    """يربط عمال السيرفر عبر الناقل
+
+    كل عامل يعلن أجهزته (join / leave / heartbeat)، فيعرف الجميع أي عامل
+    يملك كل جهاز، وتُوجَّه الأوامر إليه مباشرة. الوسائط تُنشر على قناة
+    المصدر فقط إذا كان عامل آخر يتابع هذا المصدر.
+    """
+
+    def __init__(self, worker_id=WORKER_ID):
+        self.worker_id = worker_id
+        self.origin = worker_id.encode("utf-8")
+        self.bus = None
+        self.remote_devices = {}  # {device_id: {"worker": ..., "info": {...}}}
+        self.workers = {}  # {worker_id: {"seen": وقت، "watching": {مصادر}}}
+        self.watching = set()
+        self.tasks = []
+
+    @property
+    def active(self):
+        return self.bus is not None and bool(self.workers)
+
+    async def start(self, bus_url=BUS_URL):
+        self.bus = create_bus(bus_url)
+        await self.bus.start(self.on_message)
+        await self.bus.subscribe("presence")
+        await self.bus.subscribe("broadcast")
+        await self.bus.subscribe(f"worker.{self.worker_id}")
+        self.tasks.append(asyncio.create_task(self._heartbeat()))
+        self._publish_json("presence", {"op": "hello", **self._state()})
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.bus:
+            self._publish_json("presence", {"op": "bye"})
+            await asyncio.sleep(0)
+            await self.bus.close()
+            self.bus = None
+
+    def _state(self):
+        return {
+            "devices": {dev_id: presence_info(dev_id) for dev_id in connected},
+            "watching": sorted(self.watching),
+        }
+
+    # ----- النشر -----
+    def _publish(self, channel, kind, body):
+        if self.bus is None:
+            return
+        envelope = b"".join((ENVELOPE.pack(kind, len(self.origin)), self.origin, body))
+        try:
+            self.bus.publish(channel, envelope)
+        except (ConnectionError, RuntimeError) as e:
+            log(f"❌ خطأ في النشر على الناقل: {e!r}", "ERROR")
+
+    def _publish_json(self, channel, message):
+        self._publish(channel, ENVELOPE_JSON, dumps(message).encode("utf-8"))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(CLUSTER_HEARTBEAT)
+            self._publish_json("presence", {"op": "heartbeat"})
+            self._expire_workers()
+
+    # ----- واجهة بقية السيرفر -----
+    def device_joined(self, device_id):
+        if self.bus is not None:
+            self._publish_json("presence", {"op": "join", "device": device_id,
+                                            "info": presence_info(device_id)})
+
+    def device_left(self, device_id):
+        if self.bus is not None:
+            self._publish_json("presence", {"op": "leave", "device": device_id})
+
+    def owner_of(self, device_id):
+        entry = self.remote_devices.get(device_id)
+        return entry["worker"] if entry else None
+
+    def send_to_device(self, device_id, message):
+        """تسليم رسالة لجهاز متصل بعامل آخر؛ يعيد False إن لم يكن معروفاً"""
+        owner = self.owner_of(device_id)
+        if owner is None:
+            return False
+        self._publish_json(f"worker.{owner}", {"op": "deliver", "device": device_id,
+                                               "message": message})
+        return True
+
+    def broadcast(self, message, exclude=None):
+        """بث لأجهزة العمال الآخرين؛ يعيد عدد أجهزتهم المعروفة"""
+        if not self.active:
+            return 0
+        self._publish_json("broadcast", {"op": "broadcast", "exclude": exclude,
+                                         "message": message})
+        return sum(1 for dev_id in self.remote_devices if dev_id != exclude)
+
+    def command_acked(self, message_id):
+        """تأكيد أمر أرسله عامل آخر (العامل الذي يتتبعه هو من يتعرف عليه)"""
+        if self.active:
+            self._publish_json("broadcast", {"op": "ack", "messageId": message_id})
+
+    def watch_source(self, source_id):
+        """متابعة وسائط مصدر من عمال آخرين (عند أول مشترك محلي)"""
+        if self.bus is None or source_id in self.watching:
+            return
+        self.watching.add(source_id)
+        channel = "media.*" if source_id == ALL_SOURCES else f"media.{source_id}"
+        asyncio.ensure_future(self.bus.subscribe(channel)).add_done_callback(_log_bus_error)
+        self._publish_json("presence", {"op": "watch", "source": source_id})
+
+    def publish_media(self, frame):
+        """نشر إطار محلي إن كان عامل آخر يتابع مصدره"""
+        if not self.active:
+            return
+        for state in self.workers.values():
+            watching = state["watching"]
+            if ALL_SOURCES in watching or frame.device_id in watching:
+                try:
+                    self._publish(f"media.{frame.device_id}", ENVELOPE_MEDIA, frame.to_binary())
+                except ProtocolError as e:
+                    log(f"⚠️ تعذر نشر إطار {frame.kind} من {frame.device_id} عبر الناقل: {e}", "CLUSTER")
+                return
+
+    # ----- الاستقبال -----
+    def on_message(self, channel, envelope):
+        kind, origin_len = ENVELOPE.unpack_from(envelope)
+        start = ENVELOPE.size
+        origin = envelope[start:start + origin_len].decode("utf-8")
+        if origin == self.worker_id:
+            return
+        body = memoryview(envelope)[start + origin_len:]
+        try:
+            if kind == ENVELOPE_MEDIA:
+                # إطار من عامل آخر: توجيه محلي فقط دون إعادة نشر أو تسجيل
+                frame = unpack_media(bytes(body))
+                sent, _ = fan_out(frame, media_recipients(frame))
+                catchup_cache.store(frame, viewed=sent > 0)
+            else:
+                self._on_control(origin, loads(bytes(body)))
+        except Exception as e:
+            log(f"❌ رسالة ناقل غير صالحة من {origin}: {e}", "ERROR")
+
+    def _on_control(self, origin, message):
+        op = message.get("op")
+        state = self.workers.get(origin)
+        if state is None:
+            state = self.workers[origin] = {"seen": time.time(), "watching": set()}
+        state["seen"] = time.time()
+        
+        if op in ("hello", "sync"):
+            state["watching"] = set(message.get("watching", ()))
+            for dev_id, info in message.get("devices", {}).items():
+                self._remote_joined(origin, dev_id, info)
+            if op == "hello":
+                self._publish_json("presence", {"op": "sync", **self._state()})
+        elif op == "join":
+            self._remote_joined(origin, message["device"], message["info"])
+        elif op == "leave":
+            if self.owner_of(message["device"]) == origin:
+                del self.remote_devices[message["device"]]
+                catchup_cache.forget(message["device"])
+                if message["device"] not in connected:
+                    presence.record("DEVICE_LEFT", message["device"])
+        elif op == "watch":
+            state["watching"].add(message["source"])
+        elif op == "bye":
+            self._forget_worker(origin)
+        elif op == "deliver":
+            peer = connected.get(message["device"])
+            if peer is not None:
+                peer.send(message["message"])
+        elif op == "broadcast":
+            exclude = message.get("exclude")
+            for dev_id, peer in list(connected.items()):
+                if dev_id != exclude:
+                    peer.send(message["message"])
+        elif op == "ack":
+            command_acked(message["messageId"], forward=False)
+
+    def _remote_joined(self, worker_id, device_id, info):
+        previous = self.remote_devices.get(device_id)
+        self.remote_devices[device_id] = {"worker": worker_id, "info": info}
+        if device_id in pending_commands and device_id not in connected:
+            drain_commands(device_id)
+        if device_id in connected or (previous and previous["info"] == info):
+            return
+        presence.record("DEVICE_UPDATED" if previous else "DEVICE_JOINED", device_id)
+
+    def _forget_worker(self, worker_id):
+        self.workers.pop(worker_id, None)
+        gone = [dev_id for dev_id, entry in self.remote_devices.items()
+                if entry["worker"] == worker_id]
+        for dev_id in gone:
+            del self.remote_devices[dev_id]
+            catchup_cache.forget(dev_id)
+            if dev_id not in connected:
+                presence.record("DEVICE_LEFT", dev_id)
+
+    def _expire_workers(self):
+        deadline = time.time() - CLUSTER_HEARTBEAT * 3
+        for worker_id, state in list(self.workers.items()):
+            if state["seen"] < deadline:
+                log(f"🧹 عامل لم يعد يستجيب: {worker_id}", "CLUSTER")
+                self._forget_worker(worker_id)
+
+
+def _log_bus_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        log(f"❌ خطأ في الناقل: {task.exception()!r}", "ERROR")
+
+
+def presence_info(device_id):
+    """ما يُعلن عن الجهاز لبقية العمال وفي قائمة الأجهزة"""
+    info = device_info.get(device_id, {})
+    return {
+        "name": info.get("name", f"جهاز {device_id[:4]}"),
+        "capabilities": info.get("capabilities", []),
+        "last_seen": info.get("last_seen", time.time()),
+        "commandAcks": info.get("commandAcks", False),
+    }
+
+
+cluster = Cluster()
+
+
+# ==================== الحفظ على القرص ====================
+class DiskWriter:
+    """مرحلة حفظ غير متزامنة خارج حلقة الأحداث
+
+    كل خيط كتابة له طابور محدود خاص به، ويُختار الخيط حسب مسار الملف
+    فتبقى عمليات الملف الواحد مرتبة. امتلاء الطابور يبطئ المرسل فقط.
+    """
+
+    def __init__(self, workers=DISK_WRITERS, queue_size=DISK_QUEUE_SIZE,
+                 fsync_policy=FSYNC_POLICY):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.fsync_policy = fsync_policy
+        self.shards = []
+        self.sync_task = None
+        self.dirty = False
+        self.folders = set()
+        self.writes = 0
+        self.errors = 0
+        self.bytes_written = 0
+        self.in_flight = 0
+
+    def start(self):
+        """إنشاء المجلدات مرة واحدة وتشغيل خيوط الكتابة"""
+        if self.shards:
+            return
+        for folder in MEDIA_FOLDERS:
+            self.ensure_folder(folder)
+        for i in range(self.workers):
+            queue = asyncio.Queue(self.queue_size)
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"disk-{i}")
+            task = asyncio.create_task(self._run(queue, executor))
+            self.shards.append((queue, executor, task))
+        if self.fsync_policy == "interval":
+            self.sync_task = asyncio.create_task(self._sync_loop())
+
+    def ensure_folder(self, folder):
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            self.folders.add(folder)
+
+    @property
+    def depth(self):
+        return sum(queue.qsize() for queue, _, _ in self.shards) + self.in_flight
+
+    async def submit(self, path, job, *args):
+        """جدولة job(*args) في خيط الكتابة المسؤول عن path؛ يعيد Future"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        queue = self.shards[hash(path) % len(self.shards)][0]
+        await queue.put((job, args, future, time.perf_counter()))
+        return future
+
+    async def _run(self, queue, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            job, args, future, enqueued = await queue.get()
+            self.in_flight += 1
+            try:
+                result = await loop.run_in_executor(executor, job, *args)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                self.errors += 1
+                log(f"❌ خطأ في الكتابة على القرص: {e}", "ERROR")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.in_flight -= 1
+                self.writes += 1
+                disk_write_seconds.observe(time.perf_counter() - enqueued)
+                queue.task_done()
+
+    async def _sync_loop(self):
+        # سياسة interval: مزامنة دورية واحدة بدل fsync لكل ملف
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FSYNC_INTERVAL)
+            if self.dirty:
+                self.dirty = False
+                await loop.run_in_executor(None, os.sync)
+
+    def _write(self, path, data, fsync):
+        with open(path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            else:
+                self.dirty = True
+        self.bytes_written += len(data)
+        return path
+
+    async def write_file(self, data, folder, filename, durable=False):
+        """كتابة ملف كامل؛ يعيد (المسار، Future يكتمل بعد الكتابة)"""
+        self.ensure_folder(folder)
+        filepath = os.path.join(folder, filename)
+        fsync = durable or self.fsync_policy == "always"
+        future = await self.submit(filepath, self._write, filepath, data, fsync)
+        return filepath, future
+
+    async def flush(self):
+        """انتظار انتهاء كل الكتابات المعلقة"""
+        for queue, _, _ in self.shards:
+            await queue.join()
+
+    async def close(self):
+        await self.flush()
+        for _, executor, task in self.shards:
+            task.cancel()
+            executor.shutdown(wait=True)
+        self.shards = []
+        if self.sync_task:
+            self.sync_task.cancel()
+            self.sync_task = None
+            if self.dirty:
+                os.sync()
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth,
+            "writes": self.writes,
+            "errors": self.errors,
+            "bytes": self.bytes_written,
+            "latency": disk_write_seconds.snapshot().get("all", {}),
+        }
+
+
+def _consume_exception(future):
+    # الخطأ سُجّل في خيط الكتابة؛ هذا يمنع تحذير "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+disk_writer = DiskWriter()
+
+
+async def save_file(data, folder, filename, durable=False):
+    """حفظ ملف عبر خيوط الكتابة؛ لا ينتظر القرص إلا عند طلب تأكيد دائم"""
+    filepath, future = await disk_writer.write_file(data, folder, filename, durable)
+    if durable:
+        await future
+    return filepath
+
+
+class AppendFile:
+    """ملف يُكتب تدريجياً عبر خيط الكتابة المسؤول عن مساره
+
+    الحجم يُتتبع في حلقة الأحداث عند الجدولة، فإزاحة كل كتلة معروفة
+    فوراً دون انتظار القرص.
+    """
+
+    def __init__(self, folder, filename, header=b""):
+        disk_writer.ensure_folder(folder)
+        self.path = os.path.join(folder, filename)
+        self.filename = filename
+        self.file = None
+        self.header = header
+        self.size = len(header)
+        self.closed = False
+
+    async def append(self, data, durable=False):
+        """إضافة بيانات في نهاية الملف؛ يعيد (الإزاحة، Future)"""
+        if self.closed:
+            raise ValueError(f"الملف مغلق: {self.filename}")
+        offset = self.size
+        self.size += len(data)
+        fsync = durable or disk_writer.fsync_policy == "always"
+        future = await disk_writer.submit(self.path, self._append, data, fsync)
+        return offset, future
+
+    async def close(self, finalize=None, durable=False):
+        """إغلاق الملف؛ finalize(file) تُنفَّذ في خيط الكتابة قبل الإغلاق"""
+        self.closed = True
+        fsync = durable or disk_writer.fsync_policy == "always"
+        return await disk_writer.submit(self.path, self._close, finalize, fsync)
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, "wb")
+            self.file.write(self.header)
+
+    def _append(self, data, fsync):
+        self._open()
+        self.file.write(data)
+        disk_writer.bytes_written += len(data)
+        if fsync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        else:
+            disk_writer.dirty = True
+
+    def _close(self, finalize, fsync):
+        self._open()
+        if finalize:
+            finalize(self.file)
+        if fsync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        return self.path
+
+
+# ==================== البث الصوتي المتدفق ====================
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+def wav_header(sample_rate, channels, bits, data_size=0):
+    """ترويسة WAV (PCM) بطول 44 بايت"""
+    block_align = channels * bits // 8
+    return WAV_HEADER.pack(
+        b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, channels,
+        sample_rate, sample_rate * block_align, block_align, bits,
+        b"data", data_size
+    )
+
+
+class AudioStreamSession:
+    """جلسة بث صوتي تُكتب على القرص جزءاً بجزء
+
+    الأجزاء غير المرتبة تنتظر في نافذة صغيرة؛ إذا امتلأت يُتخطى الجزء
+    المفقود. الجلسة تبقى بعد انقطاع الاتصال فيمكن استئنافها بنفس streamId.
+    """
+
+    def __init__(self, device_id, stream_id, meta):
+        self.device_id = device_id
+        self.stream_id = stream_id
+        self.sample_rate = int(meta.get('sampleRate', 16000))
+        self.channels = int(meta.get('channels', 1))
+        self.bits = int(meta.get('bitsPerSample', 16))
+        self.wav = meta.get('format', 'raw') == 'wav'
+        
+        header = wav_header(self.sample_rate, self.channels, self.bits) if self.wav else b""
+        ext = "wav" if self.wav else "raw"
+        # معرف البث في الاسم: بثان يبدآن في الثانية نفسها لا يكتبان في ملف واحد
+        self.file = AppendFile("received_audio_streams",
+                               f"stream_{safe_filename(device_id)}_{safe_filename(stream_id)}_"
+                               f"{int(time.time())}.{ext}", header)
+        self.next_seq = None
+        self.pending = {}
+        self.parts = 0
+        self.gaps = 0
+        self.late = 0
+        self.last_activity = time.time()
+
+    @property
+    def data_size(self):
+        return self.file.size - len(self.file.header)
+
+    async def add(self, sequence, data):
+        """استقبال جزء؛ يُكتب كل ما أصبح متتالياً"""
+        self.last_activity = time.time()
+        if self.next_seq is None:
+            self.next_seq = sequence
+        if sequence < self.next_seq or sequence in self.pending:
+            self.late += 1
+            return
+        self.pending[sequence] = bytes(data)
+        
+        # النافذة ممتلئة: تخطي الفجوة إلى أقدم جزء متوفر
+        if len(self.pending) > AUDIO_REORDER_WINDOW and self.next_seq not in self.pending:
+            self.gaps += 1
+            self.next_seq = min(self.pending)
+        await self._flush_ready()
+
+    async def _flush_ready(self):
+        run = []
+        while self.next_seq in self.pending:
+            run.append(self.pending.pop(self.next_seq))
+            self.next_seq += 1
+        if run:
+            self.parts += len(run)
+            await self.file.append(b"".join(run))
+
+    async def finish(self, durable=False):
+        """كتابة ما تبقى بالترتيب وإنهاء ترويسة WAV"""
+        if self.file.closed:
+            return self.data_size
+        while self.pending:
+            if self.next_seq not in self.pending:
+                self.gaps += 1
+                self.next_seq = min(self.pending)
+            await self._flush_ready()
+        
+        data_size = self.data_size
+        finalize = None
+        if self.wav:
+            header = wav_header(self.sample_rate, self.channels, self.bits, data_size)
+            finalize = lambda f: (f.seek(0), f.write(header))
+        future = await self.file.close(finalize, durable)
+        if durable:
+            await future
+        return data_size
+
+
+async def finish_audio_session(session, durable=False):
+    """إغلاق جلسة بث صوتي وإزالتها من الجلسات الجارية"""
+    key = (session.device_id, session.stream_id)
+    if audio_sessions.get(key) is session:
+        del audio_sessions[key]
+    size = await session.finish(durable)
+    log(f"💾 تم حفظ البث الكامل: {session.file.filename} - {format_size(size)}", "SAVE")
+    return session, size
+
+
+def open_audio_sessions(device_id):
+    """الجلسات القابلة للاستئناف لجهاز (تُرسل له عند إعادة التسجيل)"""
+    return [
+        {"streamId": stream_id, "nextSequence": session.next_seq}
+        for (dev_id, stream_id), session in audio_sessions.items()
+        if dev_id == device_id
+    ]
+
+
+# ==================== تسجيل الفيديو ====================
+# مدخل الفهرس: التسلسل، الإزاحة داخل المقطع، الحجم، الوقت
+INDEX_ENTRY = struct.Struct("<IQId")
+
+
+class VideoRecording:
+    """تسجيل فيديو لجهاز: مقاطع متتالية مع ملف فهرس (تسلسل → إزاحة) لكل مقطع
+
+    يُدوَّر المقطع عند تجاوز الحجم أو المدة، ويُفضَّل أن يبدأ المقطع
+    الجديد بإطار مفتاحي إن كان المرسل يعلّمها.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        # الوقت للترتيب، والجزء العشوائي حتى لا يشترك تسجيلان بدآ في الثانية نفسها بمجلد
+        self.session_id = f"{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        self.folder = os.path.join("received_videos", safe_filename(device_id), self.session_id)
+        self.segment_no = 0
+        self.segment = None
+        self.index = None
+        self.segment_started = 0
+        self.frames = 0
+        self.saw_keyframe = False
+        self.last_activity = time.time()
+
+    def _should_rotate(self, frame):
+        if self.segment is None:
+            return True
+        full = (self.segment.size >= SEGMENT_MAX_BYTES or
+                time.time() - self.segment_started >= SEGMENT_MAX_SECONDS)
+        if not full:
+            return False
+        return bool(frame.flags & FLAG_KEYFRAME) or not self.saw_keyframe
+
+    async def _close_segment(self, durable=False):
+        if self.segment is None:
+            return
+        await self.index.close(durable=durable)
+        future = await self.segment.close(durable=durable)
+        if durable:
+            await future
+
+    async def _rotate(self):
+        await self._close_segment()
+        self.segment_no += 1
+        name = f"seg_{self.segment_no:05d}"
+        self.segment = AppendFile(self.folder, f"{name}.mp4")
+        self.index = AppendFile(self.folder, f"{name}.idx")
+        self.segment_started = time.time()
+
+    async def write(self, frame):
+        self.last_activity = time.time()
+        if frame.flags & FLAG_KEYFRAME:
+            self.saw_keyframe = True
+        if self._should_rotate(frame):
+            await self._rotate()
+        data = bytes(frame.payload)
+        offset, _ = await self.segment.append(data)
+        await self.index.append(INDEX_ENTRY.pack(
+            frame.sequence & 0xFFFFFFFF, offset, len(data), float(frame.timestamp)))
+        self.frames += 1
+
+    async def close(self, durable=False):
+        await self._close_segment(durable)
+        self.segment = None
+        log(f"💾 تم حفظ تسجيل الفيديو: {self.folder} - {self.segment_no} مقطع، {self.frames} إطار", "SAVE")
+
+
+def recording_enabled(device_id):
+    return RECORD_VIDEO or device_id in recording_sources
+
+
+async def record_video_frame(frame):
+    """إضافة إطار إلى تسجيل جهازه؛ الإطار الأخير ينهي الجلسة"""
+    recording = video_recordings.get(frame.device_id)
+    if recording is None:
+        recording = video_recordings[frame.device_id] = VideoRecording(frame.device_id)
+    await recording.write(frame)
+    if frame.is_last:
+        await stop_video_recording(frame.device_id, frame.durable)
+
+
+async def stop_video_recording(device_id, durable=False):
+    recording = video_recordings.pop(device_id, None)
+    if recording is not None:
+        await recording.close(durable)
+
+
+async def expire_sessions():
+    """إغلاق جلسات الصوت والفيديو المنقطعة بعد مهلتها حتى لا تضيع تسجيلاتها"""
+    while True:
+        await asyncio.sleep(min(AUDIO_SESSION_TIMEOUT, VIDEO_SESSION_TIMEOUT) / 4)
+        now = time.time()
+        for session in list(audio_sessions.values()):
+            if session.last_activity < now - AUDIO_SESSION_TIMEOUT and not session.file.closed:
+                await finish_audio_session(session)
+        for device_id, recording in list(video_recordings.items()):
+            if recording.last_activity < now - VIDEO_SESSION_TIMEOUT:
+                await stop_video_recording(device_id)
+
+
+# ==================== الرفع المجزأ ====================
+# النوع: (المجلد، الامتداد الافتراضي، عداد الإحصائيات)
+UPLOAD_KINDS = {
+    "PHOTO": ("received_photos", "jpg", "total_photos"),
+    "AUDIO": ("received_audio", "raw", "total_audio"),
+    "VIDEO": ("received_videos", "mp4", None),
+}
+
+
+class ChunkedUpload:
+    """رفع كبير يصل أجزاءً بإزاحات متتالية ويُكتب في ملف .part فور وصوله
+
+    لا يُجدول جزء قبل انتهاء كتابة الجزء السابق، فلا يبقى في الذاكرة أكثر
+    من جزأين مهما كان حجم الملف. عند الاكتمال يُعاد تسمية الملف.
+    """
+
+    def __init__(self, device_id, upload_id, kind, filename=None):
+        folder, ext, self.counter = UPLOAD_KINDS[kind]
+        name = safe_filename(filename) if filename else f"{kind.lower()}.{ext}"
+        self.device_id = device_id
+        self.upload_id = upload_id
+        self.kind = kind
+        # معرف الرفع في الاسم: رفعان متزامنان من الجهاز نفسه لا يتشاركان ملفاً
+        self.filename = f"{safe_filename(device_id)}_{int(time.time())}_{safe_filename(upload_id)}_{name}"
+        self.path = os.path.join(folder, self.filename)
+        self.file = AppendFile(folder, self.filename + ".part")
+        self.written = None  # Future آخر جزء مجدول
+
+    @property
+    def size(self):
+        return self.file.size
+
+    async def add(self, data, durable=False):
+        if self.written is not None:
+            await self.written
+        _, self.written = await self.file.append(data, durable)
+        if durable:
+            await self.written
+
+    async def finish(self, durable=False):
+        """إغلاق الملف ثم نقله لاسمه النهائي (في خيط الكتابة نفسه فيبقى الترتيب)
+
+        ينتظر النقل دائماً: لا يُبلَّغ العميل بالاكتمال قبل وجود الملف باسمه.
+        """
+        await self.file.close(durable=durable)
+        await (await disk_writer.submit(self.file.path, os.replace, self.file.path, self.path))
+        return self.size
+
+    async def discard(self):
+        await self.file.close()
+        await disk_writer.submit(self.file.path, os.remove, self.file.path)
 
-# إحصائيات
-stats = {
-    "total_connections": 0,
-    "total_frames": 0,
-    "total_photos": 0,
-    "total_audio": 0,
-    "start_time": time.time()
+
+def send_upload_ack(peer, upload_id, offset, resync=False):
+    """الإزاحة التالية المتوقعة؛ resync تعني أن الجزء المرسل لم يُقبل"""
+    peer.send_json({
+        "type": "UPLOAD_ACK",
+        "uploadId": upload_id,
+        "offset": offset,
+        "resync": resync,
+        "timestamp": time.time()
+    })
+
+
+async def abort_upload(key, reason):
+    """إلغاء رفع جارٍ وحذف ما كُتب منه"""
+    upload = uploads.pop(key, None)
+    timer_wheel.cancel(("upload", key))
+    if upload is None:
+        return None
+    await upload.discard()
+    log(f"🗑️ إلغاء رفع {upload.filename} ({reason}) بعد {format_size(upload.size)}",
+        "UPLOAD", device=upload.device_id)
+    return upload
+
+
+def expire_upload(key):
+    asyncio.create_task(abort_upload(key[1], "timeout"))
+
+
+# ==================== معالجات الوسائط ====================
+async def handle_video_frame(peer, frame):
+    """استقبال إطار فيديو"""
+    device_id = frame.device_id
+    stats['total_frames'] += 1
+    
+    log("📹 إطار فيديو", "VIDEO", device=device_id, sequence=frame.sequence, size=frame.size)
+    
+    # إعادة التوجيه للأجهزة الأخرى
+    forwarded = route_media(frame)
+    
+    # التسجيل (فك التشفير يحدث هنا فقط)
+    recorded = recording_enabled(device_id)
+    if recorded:
+        try:
+            await record_video_frame(frame)
+        except Exception as e:
+            recorded = False
+            log(f"❌ خطأ في تسجيل الفيديو: {e}", "ERROR")
+    
+    # رد تأكيد
+    peer.send_json({
+        "type": "FRAME_RECEIVED",
+        "deviceId": device_id,
+        "sequence": frame.sequence,
+        "forwarded": forwarded,
+        "recorded": recorded,
+        "timestamp": time.time()
+    })
+
+
+async def handle_photo(peer, frame):
+    """استقبال صورة"""
+    device_id = frame.device_id
+    filename = frame.meta.get('filename', f"photo_{int(time.time())}.jpg")
+    stats['total_photos'] += 1
+    
+    try:
+        image_bytes = frame.payload
+        size_str = format_size(len(image_bytes))
+        
+        log(f"📸 صورة من {device_id} - {filename} - {size_str}", "PHOTO")
+        
+        # حفظ الصورة
+        saved_path = await save_file(image_bytes, "received_photos",
+                                     f"{safe_filename(device_id)}_{int(time.time())}.jpg", frame.durable)
+        
+        # إعادة التوجيه للأجهزة الأخرى
+        forwarded = route_media(frame)
+        
+        # رد تأكيد
+        peer.send_json({
+            "type": "PHOTO_RECEIVED",
+            "deviceId": device_id,
+            "filename": filename,
+            "saved_as": os.path.basename(saved_path),
+            "size": len(image_bytes),
+            "size_str": size_str,
+            "forwarded": forwarded,
+            "durable": frame.durable,
+            "timestamp": time.time()
+        })
+        
+    except Exception as e:
+        log(f"❌ خطأ في حفظ الصورة: {e}", "ERROR")
+
+
+async def handle_audio(peer, frame):
+    """استقبال صوت (تسجيل)"""
+    device_id = frame.device_id
+    sample_rate = frame.meta.get('sampleRate', 16000)
+    stats['total_audio'] += 1
+    
+    try:
+        audio_bytes = frame.payload
+        size_str = format_size(len(audio_bytes))
+        
+        log(f"🎤 صوت من {device_id} - {size_str} - {sample_rate}Hz", "AUDIO")
+        
+        # حفظ الصوت
+        filename = f"audio_{safe_filename(device_id)}_{int(time.time())}.raw"
+        await save_file(audio_bytes, "received_audio", filename, frame.durable)
+        
+        # إعادة التوجيه
+        forwarded = route_media(frame)
+        
+        # رد تأكيد
+        peer.send_json({
+            "type": "AUDIO_RECEIVED",
+            "deviceId": device_id,
+            "filename": filename,
+            "size_str": size_str,
+            "forwarded": forwarded,
+            "durable": frame.durable,
+            "timestamp": time.time()
+        })
+        
+    except Exception as e:
+        log(f"❌ خطأ في حفظ الصوت: {e}", "ERROR")
+
+
+async def handle_audio_stream(peer, frame):
+    """استقبال بث صوتي مباشر"""
+    device_id = frame.device_id
+    key = (device_id, str(frame.meta.get('streamId', 'default')))
+    
+    log("🔊 بث صوتي", "AUDIO_STREAM", device=device_id, sequence=frame.sequence, size=frame.size)
+    
+    # إعادة توجيه فورية
+    route_media(frame)
+    
+    # الكتابة التدريجية على القرص
+    session = audio_sessions.get(key)
+    if session is None or session.file.closed:
+        session = audio_sessions[key] = AudioStreamSession(device_id, key[1], frame.meta)
+    await session.add(frame.sequence, frame.payload)
+    
+    # إذا كان الجزء الأخير، أغلق الملف
+    if frame.is_last:
+        session, size = await finish_audio_session(session, frame.durable)
+        
+        peer.send_json({
+            "type": "AUDIO_STREAM_COMPLETE",
+            "deviceId": device_id,
+            "streamId": session.stream_id,
+            "filename": session.file.filename,
+            "size_str": format_size(size),
+            "parts": session.parts,
+            "gaps": session.gaps,
+            "timestamp": time.time()
+        })
+
+
+async def handle_upload_chunk(peer, frame):
+    """استقبال جزء من رفع مجزأ؛ يُكتب على القرص مباشرة دون تجميع الملف في الذاكرة"""
+    device_id = frame.device_id
+    problem = validate("UPLOAD_CHUNK", frame.meta)
+    if problem is not None:
+        send_error(peer, problem)
+        return
+    upload_id = str(frame.meta['uploadId'])
+    offset = frame.meta['offset']
+    key = (device_id, upload_id)
+    
+    upload = uploads.get(key)
+    if upload is None:
+        kind = frame.meta.get('kind', 'PHOTO')
+        if kind not in UPLOAD_KINDS:
+            send_error(peer, f"نوع رفع غير مدعوم: {kind}")
+            return
+        if offset != 0:
+            # رفع غير معروف (انتهت مهلته أو أُعيد تشغيل السيرفر): يبدأ من الصفر
+            send_upload_ack(peer, upload_id, 0, resync=True)
+            return
+        upload = uploads[key] = ChunkedUpload(device_id, upload_id, kind, frame.meta.get('filename'))
+        log(f"📤 بدء رفع {upload.filename}", "UPLOAD", device=device_id)
+    
+    # جزء مكرر أو بعد فجوة: يُبلَّغ العميل بالإزاحة التي يستأنف منها
+    if offset != upload.size:
+        send_upload_ack(peer, upload_id, upload.size, resync=True)
+        return
+    if upload.size + frame.size > UPLOAD_MAX_BYTES:
+        await abort_upload(key, "too_large")
+        peer.send_json({
+            "type": "UPLOAD_FAILED",
+            "uploadId": upload_id,
+            "reason": "too_large",
+            "limit": UPLOAD_MAX_BYTES,
+            "timestamp": time.time()
+        })
+        return
+    
+    timer_wheel.schedule(("upload", key), UPLOAD_TIMEOUT, expire_upload)
+    try:
+        await upload.add(frame.payload, frame.durable)
+        if not (frame.is_last or frame.meta.get('final')):
+            send_upload_ack(peer, upload_id, upload.size)
+            return
+        
+        del uploads[key]
+        timer_wheel.cancel(("upload", key))
+        size = await upload.finish(frame.durable)
+    except Exception as e:
+        log(f"❌ خطأ في كتابة الرفع: {e}", "ERROR")
+        # الرفع قد يكون أُزيل من uploads قبل الخطأ، فيُحذف ملفه مباشرة
+        uploads.pop(key, None)
+        timer_wheel.cancel(("upload", key))
+        await upload.discard()
+        peer.send_json({
+            "type": "UPLOAD_FAILED",
+            "uploadId": upload_id,
+            "reason": "disk_error",
+            "timestamp": time.time()
+        })
+        return
+    
+    if upload.counter:
+        stats[upload.counter] += 1
+    log(f"💾 اكتمل رفع {upload.filename} - {format_size(size)}", "SAVE", device=device_id)
+    peer.send_json({
+        "type": "UPLOAD_COMPLETE",
+        "uploadId": upload_id,
+        "deviceId": device_id,
+        "kind": upload.kind,
+        "saved_as": upload.filename,
+        "size": size,
+        "size_str": format_size(size),
+        "durable": frame.durable,
+        "timestamp": time.time()
+    })
+
+
+# ==================== جدول التوجيه ====================
+HANDLERS = {}  # {نوع الرسالة: معالج async (peer, data)}
+
+
+def route(*msg_types):
+    """تسجيل معالج لنوع (أو أنواع) رسائل"""
+    def register(func):
+        for msg_type in msg_types:
+            HANDLERS[msg_type] = func
+        return func
+    return register
+
+
+# حقول رسائل التحكم وأنواعها: {الحقل: (النوع، مطلوب)}. الرسالة المخالفة يُرد عليها
+# بخطأ واضح قبل وصولها للمعالج
+MESSAGE_ID = (str, int)
+MESSAGE_SCHEMAS = {
+    "REGISTER": {"deviceId": (str, True), "deviceName": (str, False), "capabilities": (list, False),
+                 "binary": (bool, False), "commandAcks": (bool, False), "knownVersion": (int, False)},
+    "GET_DEVICES": {"knownVersion": (int, False)},
+    "SUBSCRIBE": {"sourceId": (str, False), "kinds": (list, False)},
+    "UNSUBSCRIBE": {"sourceId": (str, False), "kinds": (list, False)},
+    "START_RECORDING": {"sourceId": (str, False)},
+    "STOP_RECORDING": {"sourceId": (str, False)},
+    "COMMAND": {"targetId": (str, True), "messageId": (MESSAGE_ID, False)},
+    "COMMAND_ACK": {"messageId": (MESSAGE_ID, False), "messageIds": (list, False)},
+    "VOICE_COMMAND": {"text": (str, False)},
+    "UPLOAD_CHUNK": {"uploadId": (MESSAGE_ID, True), "offset": (int, True), "final": (bool, False),
+                     "kind": (str, False), "filename": (str, False), "data": (str, False)},
 }
 
-print("=" * 70)
-print("🎯 سيرفر التحكم المتكامل - الإصدار 2.0")
-print("=" * 70)
-print(f"📡 المنفذ: {PORT}")
-print(f"🚀 بدء التشغيل: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-print("=" * 70)
 
+def validate(msg_type, data):
+    """سبب رفض الرسالة حسب MESSAGE_SCHEMAS، أو None إن كانت سليمة"""
+    schema = MESSAGE_SCHEMAS.get(msg_type)
+    if schema is None:
+        return None
+    for field, (kind, required) in schema.items():
+        value = data.get(field)
+        if value is None:
+            if required:
+                return f"الحقل {field} مطلوب في {msg_type}"
+        elif not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+            return f"نوع الحقل {field} غير صالح في {msg_type}"
+    return None
 
-# ==================== دوال مساعدة ====================
-def log(message, type="INFO"):
-    """تسجيل الرسائل مع الوقت"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {type}: {message}")
 
+async def dispatch(msg_type, func, peer, message):
+    """تنفيذ المعالج مع قياس الزمن وعدّ الأخطاء لكل نوع"""
+    started = time.perf_counter()
+    try:
+        await func(peer, message)
+    except Exception:
+        handler_errors.inc(msg_type)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, msg_type)
 
-def save_file(data, folder, filename):
-    """حفظ ملف"""
-    os.makedirs(folder, exist_ok=True)
-    filepath = os.path.join(folder, filename)
-    with open(filepath, "wb") as f:
-        f.write(data)
-    return filepath
 
+def sender_id(peer, data):
+    """معرف المرسل: من الرسالة إن وُجد وإلا معرف الاتصال المسجل"""
+    return data.get('deviceId', peer.device_id or 'unknown')
 
-def format_size(size_bytes):
-    """تنسيق حجم الملف"""
-    if size_bytes < 1024:
-        return f"{size_bytes} B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f} KB"
-    else:
-        return f"{size_bytes / (1024 * 1024):.1f} MB"
+
+def send_error(peer, message, **fields):
+    peer.send_json({
+        "type": "ERROR",
+        "message": message,
+        **fields,
+        "timestamp": time.time()
+    })
 
 
-async def broadcast_to_all(message, exclude=None):
-    """بث رسالة لجميع الأجهزة ما عدا المستبعد"""
-    sent = 0
-    disconnected = []
+MEDIA_HANDLERS = {
+    "VIDEO_FRAME": handle_video_frame,
+    "PHOTO": handle_photo,
+    "AUDIO": handle_audio,
+    "AUDIO_STREAM": handle_audio_stream,
+    "UPLOAD_CHUNK": handle_upload_chunk,
+}
+
+
+@route(*MEDIA_HANDLERS)
+async def handle_json_media(peer, data):
+    """وسائط بصيغة JSON/base64 (العملاء القدامى)؛ المصدر هو الاتصال المسجل كما في الإطارات الثنائية"""
+    device_id = peer.device_id or data.get('deviceId', 'unknown')
+    await MEDIA_HANDLERS[data['type']](peer, media_from_json(data, device_id))
+
+
+# ==================== الأوامر الموثوقة ====================
+_command_ids = itertools.count(1)
+
+
+def send_to(device_id, message):
+    """إرسال رسالة لجهاز متصل هنا أو لدى عامل آخر؛ يعيد False إن لم يكن متصلاً"""
+    peer = connected.get(device_id)
+    if peer is not None:
+        return peer.send_json(message)
+    return cluster.send_to_device(device_id, dumps(message))
+
+
+def acks_commands(device_id):
+    """هل أعلن الجهاز أنه يرسل COMMAND_ACK؟ (العملاء القدامى لا يرسلونه)"""
+    if device_id in connected:
+        return device_info.get(device_id, {}).get('commandAcks', False)
+    entry = cluster.remote_devices.get(device_id)
+    return bool(entry and entry["info"].get("commandAcks"))
+
+
+def command_message(entry):
+    return {
+        "type": "COMMAND",
+        "messageId": entry["messageId"],
+        "command": entry["command"],
+        "fromId": entry["fromId"],
+        "timestamp": entry["created"]
+    }
+
+
+def notify_sender(entry, msg_type, **fields):
+    send_to(entry["fromId"], {
+        "type": msg_type,
+        "messageId": entry["messageId"],
+        "targetId": entry["targetId"],
+        "command": entry["command"],
+        **fields,
+        "timestamp": time.time()
+    })
+
+
+def track_command(entry):
+    """انتظار تأكيد الجهاز إن كان يدعمه، مع إعادة المحاولة عند انتهاء المهلة"""
+    entry["attempts"] += 1
+    if acks_commands(entry["targetId"]):
+        inflight_commands[entry["messageId"]] = entry
+        timer_wheel.schedule(("command", entry["messageId"]), COMMAND_ACK_TIMEOUT, command_timed_out)
+
+
+def deliver_command(entry):
+    """إرسال أمر لجهازه إن كان متصلاً (هنا أو لدى عامل آخر)"""
+    if not send_to(entry["targetId"], command_message(entry)):
+        return False
+    track_command(entry)
+    return True
+
+
+def queue_command(entry):
+    """حفظ أمر لجهاز غير متصل؛ عند امتلاء طابوره يسقط الأقدم، وعند بلوغ الحد
+    الكلي يُرفض الأمر الجديد. يعيد False إن رُفض"""
+    if len(queued_commands) >= COMMAND_QUEUE_TOTAL:
+        notify_sender(entry, "COMMAND_FAILED", reason="server_queue_full")
+        return False
+    queue = pending_commands[entry["targetId"]]
+    queue.append(entry)
+    hold_command(entry)
+    if len(queue) > COMMAND_QUEUE_SIZE:
+        dropped = queue.popleft()
+        release_command(dropped)
+        notify_sender(dropped, "COMMAND_FAILED", reason="queue_full")
+    schedule_command_save()
+    return True
+
+
+def hold_command(entry):
+    # انتهاء العمر يُجدول هنا، فلا يبقى أمر لجهاز لا يتصل أبداً
+    queued_commands[entry["messageId"]] = entry
+    timer_wheel.schedule(("queued", entry["messageId"]),
+                         entry["created"] + COMMAND_TTL - time.time(), command_expired)
+
+
+def release_command(entry):
+    queued_commands.pop(entry["messageId"], None)
+    timer_wheel.cancel(("queued", entry["messageId"]))
+
+
+def command_expired(key):
+    entry = queued_commands.pop(key[1], None)
+    if entry is None:
+        return
+    queue = pending_commands.get(entry["targetId"])
+    if queue is not None and entry in queue:
+        queue.remove(entry)
+        if not queue:
+            del pending_commands[entry["targetId"]]
+    notify_sender(entry, "COMMAND_FAILED", reason="expired")
+    schedule_command_save()
+
+
+def drain_commands(device_id):
+    """تسليم أوامر الجهاز المعلقة دفعة واحدة عند اتصاله"""
+    queue = pending_commands.pop(device_id, None)
+    if not queue:
+        return
+    now = time.time()
+    entries = []
+    for entry in queue:
+        release_command(entry)
+        if now - entry["created"] > COMMAND_TTL:
+            notify_sender(entry, "COMMAND_FAILED", reason="expired")
+        else:
+            entries.append(entry)
+    schedule_command_save()
+    if not entries:
+        return
     
-    for dev_id, ws in connected.items():
-        if exclude and dev_id == exclude:
+    if acks_commands(device_id):
+        sent = send_to(device_id, {
+            "type": "COMMAND_BATCH",
+            "commands": [command_message(entry) for entry in entries],
+            "timestamp": now
+        })
+    else:
+        sent = all([send_to(device_id, command_message(entry)) for entry in entries])
+    if not sent:
+        for entry in entries:
+            pending_commands[device_id].append(entry)
+            hold_command(entry)
+        return
+    for entry in entries:
+        track_command(entry)
+    log(f"📬 تسليم {len(entries)} أمر معلق إلى {device_id}", "COMMAND", device=device_id,
+        count=len(entries))
+
+
+def command_timed_out(key):
+    entry = inflight_commands.pop(key[1], None)
+    if entry is None:
+        return
+    if entry["attempts"] > COMMAND_RETRIES or time.time() - entry["created"] > COMMAND_TTL:
+        notify_sender(entry, "COMMAND_FAILED", reason="timeout", attempts=entry["attempts"])
+        schedule_command_save()
+        log(f"⚠️ لم يُؤكَّد الأمر {entry['messageId']} من {entry['targetId']}", "COMMAND",
+            device=entry["fromId"], target=entry["targetId"], attempts=entry["attempts"])
+    elif not deliver_command(entry):
+        queue_command(entry)
+
+
+def command_acked(message_id, forward=True):
+    """تأكيد الجهاز لأمر: إيقاف إعادة المحاولة وإبلاغ المرسل"""
+    entry = inflight_commands.pop(message_id, None)
+    if entry is None:
+        if forward:
+            cluster.command_acked(message_id)
+        return
+    timer_wheel.cancel(("command", message_id))
+    notify_sender(entry, "COMMAND_DELIVERED", attempts=entry["attempts"])
+    schedule_command_save()
+
+
+def schedule_command_save():
+    # حفظ واحد لكل نبضة مهما تعددت التغييرات
+    if COMMAND_QUEUE_FILE:
+        timer_wheel.schedule(("commands", "save"), 0, save_pending_commands)
+
+
+def pending_snapshot():
+    """الأوامر المعلقة والتي تنتظر تأكيداً (الأخيرة تُعاد كأنها لم تُسلَّم)"""
+    snapshot = defaultdict(list)
+    for entry in inflight_commands.values():
+        snapshot[entry["targetId"]].append(entry)
+    for device_id, queue in pending_commands.items():
+        snapshot[device_id].extend(queue)
+    return snapshot
+
+
+# ملف هذه العملية: COMMAND_QUEUE_FILE نفسه، أو ملف لكل عامل عند التوسع الأفقي
+_command_file = {"path": COMMAND_QUEUE_FILE}
+
+
+def save_pending_commands(key=None):
+    data = json.dumps(pending_snapshot()).encode("utf-8")
+    path = _command_file["path"]
+    future = asyncio.ensure_future(disk_writer.submit(path, _replace_file, path, data))
+    future.add_done_callback(_consume_exception)
+    return future
+
+
+def _replace_file(path, data):
+    # كتابة ملف مؤقت ثم استبداله حتى لا يبقى ملف نصف مكتوب عند انقطاع التشغيل
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return path
+
+
+def load_pending_commands(path=COMMAND_QUEUE_FILE):
+    """استعادة الأوامر المحفوظة عند بدء التشغيل"""
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "rb") as f:
+            saved = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        log(f"❌ تعذر قراءة الأوامر المحفوظة: {e}", "ERROR")
+        return
+    restore_pending_commands(saved)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def adopt_command_files(key=None):
+    """ضم أوامر العمال المتوقفين (وملف التشغيل بعملية واحدة) إلى هذا العامل
+
+    كل عامل يحفظ أوامره في ملفه فقط ({COMMAND_QUEUE_FILE}.{pid})، والاستيلاء
+    على ملف يكون بإعادة تسميته، فلا يحمّل عاملان الأوامر نفسها.
+    """
+    own = _command_file["path"]
+    for path in [COMMAND_QUEUE_FILE, *glob.glob(f"{glob.escape(COMMAND_QUEUE_FILE)}.*")]:
+        owner = path[len(COMMAND_QUEUE_FILE) + 1:].removesuffix(".adopted")
+        if path == own or (owner and (not owner.isdigit() or process_alive(int(owner)))):
             continue
-        
+        claimed = f"{own}.adopted"
         try:
-            await ws.send(json.dumps(message))
-            sent += 1
-        except:
-            disconnected.append(dev_id)
+            os.rename(path, claimed)
+        except OSError:
+            continue  # لم يعد موجوداً أو استولى عليه عامل آخر
+        load_pending_commands(claimed)
+        os.remove(claimed)
+    timer_wheel.schedule(("commands", "adopt"), CLUSTER_HEARTBEAT, adopt_command_files)
+
+
+def restore_pending_commands(saved):
+    """إضافة أوامر محفوظة إلى الطوابير وتسليم ما يخص الأجهزة المتصلة فوراً"""
+    for entries in saved.values():
+        for entry in entries:
+            queue_command(entry)
+    for device_id in saved:
+        if device_id in connected:
+            drain_commands(device_id)
+    log(f"📥 استعادة أوامر معلقة لـ {len(saved)} جهاز", "COMMAND")
+
+
+# ==================== معالجات رسائل التحكم ====================
+@route('REGISTER')
+async def handle_register(peer, data):
+    """تسجيل جهاز جديد"""
+    device_id = data['deviceId']
+    device_name = data.get('deviceName', 'جهاز غير معروف')
+    capabilities = data.get('capabilities', [])
+    binary = bool(data.get('binary', False))
+    command_acks = bool(data.get('commandAcks', False))
+    peer.zstd = data.get('compression') == "zstd" and _zstd is not None
     
-    # تنظيف الأجهزة المنفصلة
-    for dev_id in disconnected:
-        if dev_id in connected:
-            del connected[dev_id]
-            log(f"🧹 تنظيف جهاز غير متصل: {dev_id}", "CLEAN")
+    peer.device_id = device_id
+    peer.binary = binary
+    reconnected = device_id in connected or device_id in cluster.remote_devices
+    connected[device_id] = peer
+    came_online(device_id)
+    viewer = subscribe_by_capabilities(device_id, capabilities)
+    device_info[device_id] = {
+        'name': device_name,
+        'capabilities': capabilities,
+        'binary': binary,
+        'commandAcks': command_acks,
+        'last_seen': time.time(),
+        'connected_at': time.time()
+    }
+    stats['total_connections'] += 1
     
-    return sent
+    log(f"✅ جهاز جديد: {device_name}", "REGISTER", device=device_id,
+        name=device_name, capabilities=capabilities, binary=binary,
+        connected_devices=len(connected))
+    
+    # رد تأكيد التسجيل
+    peer.send_json({
+        "type": "REGISTERED",
+        "deviceId": device_id,
+        "message": "تم التسجيل بنجاح",
+        "connected_devices": len(connected),
+        "binary": binary,
+        "binaryVersion": BINARY_VERSION,
+        "compression": "zstd" if peer.zstd else None,
+        "audioSessions": open_audio_sessions(device_id),
+        "timestamp": time.time()
+    })
+    
+    # حالة القائمة للجهاز الجديد، وحدث حضور واحد لبقية الأجهزة
+    presence.record("DEVICE_UPDATED" if reconnected else "DEVICE_JOINED", device_id)
+    presence.send_state(peer, data.get('knownVersion'), data.get('epoch'))
+    cluster.device_joined(device_id)
+    drain_commands(device_id)
+    if viewer:
+        catchup_cache.replay(peer, ALL_SOURCES, MEDIA_TYPES)
+
+
+@route('GET_DEVICES')
+async def handle_get_devices(peer, data):
+    """طلب قائمة الأجهزة (أو ما فات منذ knownVersion فقط)"""
+    presence.send_state(peer, data.get('knownVersion'), data.get('epoch'))
+    log(f"📋 إرسال قائمة الأجهزة إلى {sender_id(peer, data)}", "DEVICES")
+
+
+@route('HEARTBEAT')
+async def handle_heartbeat(peer, data):
+    """نبض من عميل لا يرسل غيره؛ أي رسالة تكفي لتحديث آخر نشاط"""
+
+
+@route('SUBSCRIBE', 'UNSUBSCRIBE')
+async def handle_subscribe(peer, data):
+    """الاشتراك في وسائط مصدر أو إلغاؤه"""
+    msg_type = data['type']
+    device_id = sender_id(peer, data)
+    source_id = data.get('sourceId', ALL_SOURCES)
+    kinds = data.get('kinds') or list(MEDIA_TYPES)
+    unknown = [k for k in kinds if k not in MEDIA_TYPES]
+    
+    if connected.get(device_id) is not peer:
+        send_error(peer, "يجب التسجيل قبل الاشتراك")
+        return
+    if unknown:
+        send_error(peer, f"أنواع وسائط غير معروفة: {unknown}")
+        return
+    
+    if msg_type == 'SUBSCRIBE':
+        subscribe(device_id, source_id, kinds)
+    else:
+        unsubscribe(device_id, source_id, kinds)
+    peer.send_json({
+        "type": "SUBSCRIBED" if msg_type == 'SUBSCRIBE' else "UNSUBSCRIBED",
+        "sourceId": source_id,
+        "kinds": kinds,
+        "timestamp": time.time()
+    })
+    replayed = catchup_cache.replay(peer, source_id, kinds) if msg_type == 'SUBSCRIBE' else 0
+    log(f"🔔 {msg_type} {device_id} ← {source_id}: {kinds}", "SUBSCRIBE", replayed=replayed)
+
+
+@route('START_RECORDING', 'STOP_RECORDING')
+async def handle_recording(peer, data):
+    """تشغيل / إيقاف تسجيل فيديو مصدر"""
+    msg_type = data['type']
+    device_id = sender_id(peer, data)
+    source_id = data.get('sourceId', device_id)
+    if msg_type == 'START_RECORDING':
+        recording_sources.add(source_id)
+    else:
+        recording_sources.discard(source_id)
+        await stop_video_recording(source_id)
+    
+    peer.send_json({
+        "type": "RECORDING_STATUS",
+        "sourceId": source_id,
+        "recording": recording_enabled(source_id),
+        "timestamp": time.time()
+    })
+    log(f"⏺️ {msg_type} للجهاز {source_id} من {device_id}", "RECORD")
 
 
-async def send_device_list(target_ws=None):
-    """إرسال قائمة الأجهزة"""
-    devices_list = []
-    for dev_id, ws in connected.items():
-        info = device_info.get(dev_id, {})
-        devices_list.append({
-            "id": dev_id,
-            "name": info.get("name", f"جهاز {dev_id[:4]}"),
-            "capabilities": info.get("capabilities", []),
-            "last_seen": info.get("last_seen", time.time()),
-            "status": "online"
+@route('COMMAND')
+async def handle_command(peer, data):
+    """إرسال أمر لجهاز محدد (يُحفظ حتى اتصاله إن لم يكن متصلاً)"""
+    target_id = data.get('targetId')
+    command = data.get('command')
+    from_id = data.get('fromId', sender_id(peer, data))
+    entry = {
+        "messageId": str(data.get('messageId') or f"{WORKER_ID}-{next(_command_ids)}"),
+        "targetId": target_id,
+        "fromId": from_id,
+        "command": command,
+        "created": time.time(),
+        "attempts": 0
+    }
+    
+    if deliver_command(entry):
+        peer.send_json({
+            "type": "COMMAND_SENT",
+            "messageId": entry["messageId"],
+            "targetId": target_id,
+            "command": command,
+            "awaitingAck": entry["messageId"] in inflight_commands,
+            "message": "تم إرسال الأمر",
+            "timestamp": time.time()
+        })
+        
+        log(f"📤 أمر إلى {target_id}", "COMMAND", device=from_id,
+            target=target_id, command=command)
+    elif queue_command(entry):
+        peer.send_json({
+            "type": "COMMAND_QUEUED",
+            "messageId": entry["messageId"],
+            "targetId": target_id,
+            "command": command,
+            "message": f"الجهاز {target_id} غير متصل، سيُسلَّم الأمر عند اتصاله",
+            "timestamp": time.time()
         })
+        log(f"📥 أمر بانتظار اتصال {target_id}", "COMMAND", device=from_id,
+            target=target_id, command=command)
+
+
+@route('COMMAND_ACK')
+async def handle_command_ack(peer, data):
+    """تأكيد الجهاز تنفيذ أمر أو دفعة أوامر"""
+    for message_id in data.get('messageIds') or [data.get('messageId')]:
+        if message_id is not None:
+            command_acked(str(message_id))
+
+
+@route('BROADCAST')
+async def handle_broadcast(peer, data):
+    """بث أمر للجميع"""
+    command = data.get('command')
+    from_id = data.get('fromId', sender_id(peer, data))
     
     message = {
-        "type": "DEVICE_LIST",
-        "devices": devices_list,
-        "count": len(devices_list),
+        "type": "COMMAND",
+        "command": command,
+        "fromId": from_id,
+        "broadcast": True,
         "timestamp": time.time()
     }
+    recipients = [(dev_id, ws) for dev_id, ws in connected.items()
+                  if dev_id != from_id]
+    sent, failed = fan_out(message, recipients)
+    sent += cluster.broadcast(dumps(message), exclude=from_id)
     
-    if target_ws:
-        await target_ws.send(json.dumps(message))
-    else:
-        await broadcast_to_all(message)
+    peer.send_json({
+        "type": "BROADCAST_SENT",
+        "count": sent,
+        "failed": list(failed),
+        "message": f"تم إرسال الأمر إلى {sent} جهاز",
+        "timestamp": time.time()
+    })
+    
+    log(f"📢 بث من {from_id} إلى {sent} جهاز: {command}", "BROADCAST")
+
+
+@route('VOICE_COMMAND')
+async def handle_voice_command(peer, data):
+    """أمر صوتي"""
+    device_id = sender_id(peer, data)
+    command_text = data.get('text', '')
+    confidence = data.get('confidence', 0)
+    
+    log(f"🗣️ أمر صوتي من {device_id}: '{command_text}' (الثقة: {confidence}%)", "VOICE")
+    
+    # تحويل الأمر الصوتي إلى أمر عادي وتنفيذه
+    if 'شغل' in command_text or 'ابدأ' in command_text:
+        # إرسال أمر بدء البث للجهاز نفسه
+        pass
+    
+    peer.send_json({
+        "type": "VOICE_COMMAND_RECEIVED",
+        "deviceId": device_id,
+        "command": command_text,
+        "confidence": confidence,
+        "timestamp": time.time()
+    })
+
+
+_stats_cache = {"built": 0.0, "encode": None}
+
+
+def stats_encoder():
+    """ترميز رسالة STATS، يُعاد استخدامه خلال STATS_CACHE_INTERVAL إن فُعّل
+
+    بناء اللقطة (طوابير كل الأجهزة وكل المقاييس) أغلى بكثير من ترميزها،
+    فعند تفعيل التخزين تتشارك الطلبات المتكررة خلال المدة لقطة واحدة.
+    """
+    now = time.monotonic()
+    if _stats_cache["encode"] is None or now - _stats_cache["built"] >= STATS_CACHE_INTERVAL:
+        _stats_cache["built"] = now
+        _stats_cache["encode"] = encoder_for(stats_message())
+    return _stats_cache["encode"]
+
+
+@route('GET_STATS')
+async def handle_get_stats(peer, data):
+    """طلب إحصائيات"""
+    peer.send(stats_encoder()(peer), kind="STATS")
+
+
+def stats_message():
+    uptime = time.time() - stats['start_time']
+    hours = int(uptime // 3600)
+    minutes = int((uptime % 3600) // 60)
+    
+    return {
+        "type": "STATS",
+        "connected_devices": len(connected),
+        "total_frames": stats['total_frames'],
+        "total_photos": stats['total_photos'],
+        "total_audio": stats['total_audio'],
+        "dropped_frames": stats['dropped_frames'],
+        "queues": queue_stats(),
+        "offline_devices": len(offline_devices),
+        "pending_commands": len(queued_commands),
+        "inflight_commands": len(inflight_commands),
+        "timers": len(timer_wheel),
+        "disk": disk_writer.stats(),
+        "catchup": catchup_cache.stats(),
+        "uploads": len(uploads),
+        "metrics": metrics.snapshot(),
+        "uptime": f"{hours}h {minutes}m",
+        "serializer": SERIALIZER_NAME,
+        "timestamp": time.time()
+    }
+
+
+async def handle_unknown(peer, data):
+    """أمر غير معروف"""
+    msg_type = data.get('type', 'unknown')
+    log(f"⚠️ أمر غير معروف: {msg_type} من {sender_id(peer, data)}", "WARNING")
+    send_error(peer, f"أمر غير معروف: {msg_type}")
 
 
 # ==================== معالج الاتصالات الرئيسي ====================
 async def handler(websocket):
-    """معالجة جميع أنواع الاتصالات"""
-    device_id = None
+    """استقبال الرسائل وتوجيهها عبر جدول المعالجات"""
+    peer = Peer(websocket)
+    watch_peer(peer)
     
     try:
-        # ===== 1️⃣ استقبال الرسائل =====
         async for message in websocket:
             try:
-                data = json.loads(message)
-                msg_type = data.get('type', 'unknown')
-                device_id = data.get('deviceId', device_id or 'unknown')
-                
-                # تحديث آخر ظهور للجهاز
-                if device_id and device_id != 'unknown':
-                    if device_id in device_info:
-                        device_info[device_id]['last_seen'] = time.time()
-                
-                # ===== 2️⃣ تسجيل جهاز جديد =====
-                if msg_type == 'REGISTER':
-                    device_id = data['deviceId']
-                    device_name = data.get('deviceName', 'جهاز غير معروف')
-                    capabilities = data.get('capabilities', [])
-                    
-                    connected[device_id] = websocket
-                    device_info[device_id] = {
-                        'name': device_name,
-                        'capabilities': capabilities,
-                        'last_seen': time.time(),
-                        'connected_at': time.time()
-                    }
-                    stats['total_connections'] += 1
-                    
-                    log(f"✅ جهاز جديد: {device_name} ({device_id})", "REGISTER")
-                    log(f"📋 الإمكانيات: {capabilities}", "INFO")
-                    log(f"📊 إجمالي الأجهزة: {len(connected)}", "STATS")
-                    
-                    # رد تأكيد التسجيل
-                    await websocket.send(json.dumps({
-                        "type": "REGISTERED",
-                        "deviceId": device_id,
-                        "message": "تم التسجيل بنجاح",
-                        "connected_devices": len(connected),
-                        "timestamp": time.time()
-                    }))
-                    
-                    # بث قائمة الأجهزة للجميع
-                    await send_device_list()
-                
-                # ===== 3️⃣ طلب قائمة الأجهزة =====
-                elif msg_type == 'GET_DEVICES':
-                    await send_device_list(websocket)
-                    log(f"📋 إرسال قائمة الأجهزة إلى {device_id}", "DEVICES")
-                
-                # ===== 4️⃣ إرسال أمر لجهاز محدد =====
-                elif msg_type == 'COMMAND':
-                    target_id = data.get('targetId')
-                    command = data.get('command')
-                    from_id = data.get('fromId', device_id)
-                    
-                    if target_id in connected:
-                        await connected[target_id].send(json.dumps({
-                            "type": "COMMAND",
-                            "command": command,
-                            "fromId": from_id,
-                            "timestamp": time.time()
-                        }))
-                        
-                        await websocket.send(json.dumps({
-                            "type": "COMMAND_SENT",
-                            "targetId": target_id,
-                            "command": command,
-                            "message": "تم إرسال الأمر",
-                            "timestamp": time.time()
-                        }))
-                        
-                        log(f"📤 أمر من {from_id} إلى {target_id}: {command}", "COMMAND")
-                    else:
-                        await websocket.send(json.dumps({
-                            "type": "ERROR",
-                            "message": f"الجهاز {target_id} غير متصل",
-                            "timestamp": time.time()
-                        }))
-                        log(f"⚠️ جهاز غير متصل: {target_id}", "ERROR")
-                
-                # ===== 5️⃣ بث أمر للجميع =====
-                elif msg_type == 'BROADCAST':
-                    command = data.get('command')
-                    from_id = data.get('fromId', device_id)
-                    
-                    sent = await broadcast_to_all({
-                        "type": "COMMAND",
-                        "command": command,
-                        "fromId": from_id,
-                        "broadcast": True,
-                        "timestamp": time.time()
-                    }, exclude=from_id)
-                    
-                    await websocket.send(json.dumps({
-                        "type": "BROADCAST_SENT",
-                        "count": sent,
-                        "message": f"تم إرسال الأمر إلى {sent} جهاز",
-                        "timestamp": time.time()
-                    }))
-                    
-                    log(f"📢 بث من {from_id} إلى {sent} جهاز: {command}", "BROADCAST")
+                size = wire_size(message)
+                # ميزانية الوارد: الانتظار هنا يوقف القراءة فيُبطئ TCP المرسل نفسه
+                if peer.budget is not None:
+                    delay = peer.budget.take(size, INBOUND_MAX_DELAY)
+                    if delay is None:
+                        reject_inbound(peer, inbound_kind(message), "rate", size)
+                        continue
+                    if delay:
+                        throttled_seconds.inc(value=delay)
+                        await asyncio.sleep(delay)
                 
-                # ===== 6️⃣ استقبال فيديو =====
-                elif msg_type == 'VIDEO_FRAME':
-                    frame_data = data.get('frame', '')
-                    timestamp = data.get('timestamp', time.time())
-                    sequence = data.get('sequence', 0)
-                    is_last = data.get('isLast', False)
-                    
-                    stats['total_frames'] += 1
-                    
-                    # فك تشفير
-                    try:
-                        frame_bytes = base64.b64decode(frame_data)
-                        size_str = format_size(len(frame_bytes))
-                        log(f"📹 فيديو من {device_id} - الإطار #{sequence} - {size_str}", "VIDEO")
-                        
-                        # حفظ الفيديو إذا كان آخر إطار (اختياري)
-                        if is_last:
-                            filename = f"video_{device_id}_{int(time.time())}.mp4"
-                            save_file(frame_bytes, "received_videos", filename)
-                            log(f"💾 تم حفظ الفيديو: {filename}", "SAVE")
-                        
-                    except Exception as e:
-                        log(f"❌ خطأ في فك تشفير الفيديو: {e}", "ERROR")
-                    
-                    # إعادة التوجيه للأجهزة الأخرى
-                    forwarded = await broadcast_to_all({
-                        "type": "VIDEO_FRAME",
-                        "deviceId": device_id,
-                        "frame": frame_data,
-                        "sequence": sequence,
-                        "isLast": is_last,
-                        "timestamp": timestamp
-                    }, exclude=device_id)
-                    
-                    # رد تأكيد
-                    await websocket.send(json.dumps({
-                        "type": "FRAME_RECEIVED",
-                        "deviceId": device_id,
-                        "sequence": sequence,
-                        "forwarded": forwarded,
-                        "timestamp": time.time()
-                    }))
+                # ===== إطار وسائط ثنائي =====
+                if isinstance(message, bytes):
+                    frame = unpack_media(message)
+                    if size > size_limit(frame.kind):
+                        reject_inbound(peer, frame.kind, "size", size)
+                        continue
+                    messages_total.inc(frame.kind, "in")
+                    bytes_total.inc(frame.kind, "in", value=size)
+                    if peer.device_id is not None and frame.device_id != peer.device_id:
+                        frame = rebind_media(frame, peer.device_id)
+                    peer.seen = timer_wheel.now
+                    await dispatch(frame.kind, MEDIA_HANDLERS[frame.kind], peer, frame)
+                    continue
                 
-                # ===== 7️⃣ استقبال صورة =====
-                elif msg_type == 'PHOTO':
-                    image_data = data.get('image', '')
-                    filename = data.get('filename', f"photo_{int(time.time())}.jpg")
-                    
-                    stats['total_photos'] += 1
-                    
-                    try:
-                        image_bytes = base64.b64decode(image_data)
-                        size_str = format_size(len(image_bytes))
-                        
-                        log(f"📸 صورة من {device_id} - {filename} - {size_str}", "PHOTO")
-                        
-                        # حفظ الصورة
-                        saved_path = save_file(image_bytes, "received_photos", 
-                                              f"{device_id}_{int(time.time())}.jpg")
-                        
-                        # إعادة التوجيه للأجهزة الأخرى
-                        forwarded = await broadcast_to_all({
-                            "type": "PHOTO",
-                            "deviceId": device_id,
-                            "image": image_data,
-                            "filename": filename,
-                            "timestamp": time.time()
-                        }, exclude=device_id)
-                        
-                        # رد تأكيد
-                        await websocket.send(json.dumps({
-                            "type": "PHOTO_RECEIVED",
-                            "deviceId": device_id,
-                            "filename": filename,
-                            "saved_as": os.path.basename(saved_path),
-                            "size": len(image_bytes),
-                            "size_str": size_str,
-                            "forwarded": forwarded,
-                            "timestamp": time.time()
-                        }))
-                        
-                    except Exception as e:
-                        log(f"❌ خطأ في حفظ الصورة: {e}", "ERROR")
-                
-                # ===== 8️⃣ استقبال صوت (تسجيل) =====
-                elif msg_type == 'AUDIO':
-                    audio_data = data.get('audio', '')
-                    sample_rate = data.get('sampleRate', 16000)
-                    channels = data.get('channels', 1)
-                    duration = data.get('duration', 0)
-                    
-                    stats['total_audio'] += 1
-                    
-                    try:
-                        audio_bytes = base64.b64decode(audio_data)
-                        size_str = format_size(len(audio_bytes))
-                        
-                        log(f"🎤 صوت من {device_id} - {size_str} - {sample_rate}Hz", "AUDIO")
-                        
-                        # حفظ الصوت
-                        filename = f"audio_{device_id}_{int(time.time())}.raw"
-                        saved_path = save_file(audio_bytes, "received_audio", filename)
-                        
-                        # إعادة التوجيه
-                        forwarded = await broadcast_to_all({
-                            "type": "AUDIO",
-                            "deviceId": device_id,
-                            "audio": audio_data,
-                            "sampleRate": sample_rate,
-                            "channels": channels,
-                            "timestamp": time.time()
-                        }, exclude=device_id)
-                        
-                        # رد تأكيد
-                        await websocket.send(json.dumps({
-                            "type": "AUDIO_RECEIVED",
-                            "deviceId": device_id,
-                            "filename": filename,
-                            "size_str": size_str,
-                            "forwarded": forwarded,
-                            "timestamp": time.time()
-                        }))
-                        
-                    except Exception as e:
-                        log(f"❌ خطأ في حفظ الصوت: {e}", "ERROR")
-                
-                # ===== 9️⃣ استقبال بث صوتي مباشر =====
-                elif msg_type == 'AUDIO_STREAM':
-                    audio_data = data.get('audio', '')
-                    sequence = data.get('sequence', 0)
-                    is_last = data.get('isLast', False)
-                    sample_rate = data.get('sampleRate', 16000)
-                    
-                    # تخزين في المخزن المؤقت
-                    audio_buffers[device_id].append({
-                        'seq': sequence,
-                        'data': audio_data,
-                        'time': time.time()
-                    })
-                    
-                    log(f"🔊 بث صوتي من {device_id} - الجزء {sequence}", "AUDIO_STREAM")
-                    
-                    # إعادة توجيه فورية
-                    await broadcast_to_all({
-                        "type": "AUDIO_STREAM",
-                        "deviceId": device_id,
-                        "audio": audio_data,
-                        "sequence": sequence,
-                        "isLast": is_last,
-                        "sampleRate": sample_rate,
-                        "timestamp": time.time()
-                    }, exclude=device_id)
-                    
-                    # إذا كان الجزء الأخير، قم بدمج وحفظ
-                    if is_last and device_id in audio_buffers:
-                        all_parts = sorted(audio_buffers[device_id], key=lambda x: x['seq'])
-                        
-                        # دمج الأجزاء
-                        combined = bytearray()
-                        for part in all_parts:
-                            combined.extend(base64.b64decode(part['data']))
-                        
-                        # حفظ الملف الكامل
-                        filename = f"stream_{device_id}_{int(time.time())}.raw"
-                        saved_path = save_file(combined, "received_audio_streams", filename)
-                        
-                        log(f"💾 تم حفظ البث الكامل: {filename} - {format_size(len(combined))}", "SAVE")
-                        
-                        # تنظيف المخزن
-                        del audio_buffers[device_id]
-                        
-                        await websocket.send(json.dumps({
-                            "type": "AUDIO_STREAM_COMPLETE",
-                            "deviceId": device_id,
-                            "filename": filename,
-                            "size_str": format_size(len(combined)),
-                            "parts": len(all_parts),
-                            "timestamp": time.time()
-                        }))
-                
-                # ===== 🔟 أمر صوتي =====
-                elif msg_type == 'VOICE_COMMAND':
-                    command_text = data.get('text', '')
-                    confidence = data.get('confidence', 0)
-                    audio_data = data.get('audio', '')
-                    
-                    log(f"🗣️ أمر صوتي من {device_id}: '{command_text}' (الثقة: {confidence}%)", "VOICE")
-                    
-                    # تحويل الأمر الصوتي إلى أمر عادي وتنفيذه
-                    if 'شغل' in command_text or 'ابدأ' in command_text:
-                        # إرسال أمر بدء البث للجهاز نفسه
-                        pass
-                    
-                    await websocket.send(json.dumps({
-                        "type": "VOICE_COMMAND_RECEIVED",
-                        "deviceId": device_id,
-                        "command": command_text,
-                        "confidence": confidence,
-                        "timestamp": time.time()
-                    }))
-                
-                # ===== 1️⃣1️⃣ طلب إحصائيات =====
-                elif msg_type == 'GET_STATS':
-                    uptime = time.time() - stats['start_time']
-                    hours = int(uptime // 3600)
-                    minutes = int((uptime % 3600) // 60)
-                    
-                    await websocket.send(json.dumps({
-                        "type": "STATS",
-                        "connected_devices": len(connected),
-                        "total_frames": stats['total_frames'],
-                        "total_photos": stats['total_photos'],
-                        "total_audio": stats['total_audio'],
-                        "uptime": f"{hours}h {minutes}m",
-                        "timestamp": time.time()
-                    }))
+                # ===== رسالة JSON =====
+                # الرسالة الأكبر من حد التحكم لا تُحلَّل إن أعلنت بدايتها نوعاً بحد أصغر؛
+                # وإن لم يظهر نوعها في البداية فالحد الأكبر، ثم يُطبَّق حد نوعها بعد التحليل
+                if size > CONTROL_MAX_SIZE:
+                    sniffed = sniff_type(message)
+                    if size > (size_limit(sniffed) if sniffed != "UNKNOWN" else LARGEST_SIZE_LIMIT):
+                        reject_inbound(peer, sniffed, "size", size)
+                        continue
+                data = loads(message)
+                msg_type = data.get('type', 'unknown')
+                if msg_type not in HANDLERS:
+                    msg_type = 'UNKNOWN'
+                if size > size_limit(msg_type):
+                    reject_inbound(peer, msg_type, "size", size)
+                    continue
+                messages_total.inc(msg_type, "in")
+                bytes_total.inc(msg_type, "in", value=size)
                 
-                # ===== 1️⃣2️⃣ أمر غير معروف =====
-                else:
-                    log(f"⚠️ أمر غير معروف: {msg_type} من {device_id}", "WARNING")
-                    await websocket.send(json.dumps({
-                        "type": "ERROR",
-                        "message": f"أمر غير معروف: {msg_type}",
-                        "timestamp": time.time()
-                    }))
+                peer.seen = timer_wheel.now
+                problem = validate(msg_type, data)
+                if problem is not None:
+                    handler_errors.inc(msg_type)
+                    send_error(peer, problem)
+                    continue
+                await dispatch(msg_type, HANDLERS.get(msg_type, handle_unknown), peer, data)
             
-            except json.JSONDecodeError:
+            except ProtocolError as e:
+                log(f"❌ إطار ثنائي غير صالح من {peer.device_id}: {e}", "ERROR")
+            except DECODE_ERRORS:
                 log(f"❌ رسالة غير صالحة: {message[:100]}...", "ERROR")
             except Exception as e:
                 log(f"❌ خطأ في معالجة الرسالة: {e}", "ERROR")
     
     except websockets.exceptions.ConnectionClosed:
-        log(f"🔴 قطع الاتصال: {device_id}", "DISCONNECT")
+        log(f"🔴 قطع الاتصال: {peer.device_id}", "DISCONNECT")
     except Exception as e:
         log(f"❌ خطأ عام: {e}", "ERROR")
     finally:
         # تنظيف عند قطع الاتصال
-        if device_id and device_id in connected:
-            del connected[device_id]
-            if device_id in device_info:
-                device_info[device_id]['last_seen'] = time.time()
-            if device_id in audio_buffers:
-                del audio_buffers[device_id]
-            if device_id in video_buffers:
-                del video_buffers[device_id]
-            
-            log(f"📊 الأجهزة المتبقية: {len(connected)}", "CLEAN")
-            
-            # بث القائمة المحدثة
-            await send_device_list()
+        drop_peer(peer)
 
 
 # ==================== فحص الصحة ====================
 async def health_check(path, request_headers):
-    """فحص صحي للسيرفر"""
+    """فحص صحي للسيرفر ومقاييس Prometheus (طلبات HTTP العادية فقط)"""
+    if request_headers.get("Upgrade", "").lower() == "websocket":
+        return None
     if path == "/":
         uptime = time.time() - stats['start_time']
-        return websockets.http.Headers(), 200, json.dumps({
+        return http.HTTPStatus.OK, [("Content-Type", "application/json")], dumps({
             "status": "running",
             "connected_devices": len(connected),
             "uptime_seconds": int(uptime),
+            "dropped_frames": stats['dropped_frames'],
+            "queues": queue_stats(),
+            "disk": disk_writer.stats(),
             "version": "2.0"
         }).encode()
+    if path == "/metrics":
+        return (http.HTTPStatus.OK,
+                [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")],
+                metrics.render().encode())
     return None
 
 
+# ==================== الإيقاف التدريجي ====================
+async def drain(ws_server, handoff=None):
+    """إيقاف دون فقد بيانات: إيقاف قبول الاتصالات، إبلاغ العملاء بمهلة عشوائية
+    لإعادة الاتصال، إغلاق الجلسات المفتوحة على القرص، ثم حفظ الأوامر المعلقة
+
+    handoff أنبوب النسخة الجديدة عند إعادة التشغيل: تُسلَّم الأوامر المعلقة لها
+    بدل ملف الحفظ.
+    """
+    started = time.monotonic()
+    ws_server.close(close_connections=False)
+    peers = list(connected.values())
+    log(f"🛑 إيقاف تدريجي: {len(peers)} جهاز متصل", "STOP")
+    
+    reason = "restart" if handoff is not None else "shutdown"
+    for peer in peers:
+        peer.live.clear()
+        peer.send_json({
+            "type": "SERVER_DRAINING",
+            "reason": reason,
+            "reconnectIn": round(random.uniform(RECONNECT_DELAY_MIN, RECONNECT_DELAY_MAX), 3),
+            "timestamp": time.time()
+        })
+    # نصف المهلة لتفريغ الطوابير والباقي لإغلاق الاتصالات (عميل لا يرد لا يؤخر الإيقاف)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    await asyncio.gather(*(peer.flush(DRAIN_TIMEOUT / 2) for peer in peers))
+    closing = [asyncio.create_task(ws.close(1012, "service restart"))
+               for ws in list(ws_server.websockets)]
+    try:
+        await asyncio.wait_for(ws_server.wait_closed(), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        log(f"⚠️ انتهت مهلة الإغلاق، {sum(not task.done() for task in closing)} اتصال لم يرد", "WARNING")
+    for task in closing:
+        task.cancel()
+
+    # الجلسات المفتوحة: البث الصوتي والتسجيل يُغلقان بترويسات صحيحة، والرفع
+    # غير المكتمل يبقى ملف .part كما هو
+    for session in list(audio_sessions.values()):
+        await finish_audio_session(session, durable=True)
+    for device_id in list(video_recordings):
+        await stop_video_recording(device_id, durable=True)
+    for key, upload in list(uploads.items()):
+        del uploads[key]
+        await upload.file.close(durable=True)
+        log(f"📦 رفع غير مكتمل محفوظ: {upload.file.filename} - {format_size(upload.size)}", "SAVE")
+    
+    if handoff is not None:
+        data = json.dumps(pending_snapshot()).encode("utf-8")
+        await asyncio.get_running_loop().run_in_executor(None, _write_handoff, handoff, data)
+    elif COMMAND_QUEUE_FILE:
+        await (await save_pending_commands())
+    await cluster.close()
+    await disk_writer.close()
+    log(f"👋 اكتمل الإيقاف خلال {time.monotonic() - started:.2f}s", "STOP")
+
+
+def wait_for_signal(*signals):
+    """Future يكتمل برقم أول إشارة تصل من signals"""
+    loop = asyncio.get_running_loop()
+    received = loop.create_future()
+    for sig in signals:
+        loop.add_signal_handler(sig, lambda sig=sig: received.done() or received.set_result(sig))
+    return received
+
+
+# ==================== إعادة التشغيل دون انقطاع ====================
+# SIGHUP: تُشغَّل نسخة جديدة ترث مقبس الاستماع نفسه، فتنتظر الاتصالات الجديدة في
+# طابور النواة بدل رفضها، وبعد جاهزيتها تتوقف النسخة القديمة تدريجياً وتسلمها
+# الأوامر المعلقة عبر أنبوب.
+def inherited_socket():
+    """مقبس الاستماع الموروث من النسخة السابقة (LISTEN_FD) إن وُجد"""
+    if not LISTEN_FD:
+        return None
+    return socket.socket(fileno=int(LISTEN_FD))
+
+
+def signal_ready(ready=None):
+    """إبلاغ من ينتظر قبول هذه النسخة للاتصالات: النسخة السابقة أو المشرف (ready)"""
+    if ready is not None:
+        ready.set()
+    if READY_FD:
+        os.write(int(READY_FD), b"1")
+        os.close(int(READY_FD))
+
+
+async def spawn_successor(ws_server):
+    """تشغيل النسخة الجديدة وانتظار جاهزيتها؛ يعيد أنبوب التسليم أو None عند الفشل"""
+    listen_fd = ws_server.sockets[0].fileno()
+    ready_read, ready_write = os.pipe()
+    handoff_read, handoff_write = os.pipe()
+    env = dict(os.environ, LISTEN_FD=str(listen_fd), READY_FD=str(ready_write),
+               HANDOFF_FD=str(handoff_read))
+    process = subprocess.Popen([sys.executable, *sys.argv], env=env,
+                               pass_fds=(listen_fd, ready_write, handoff_read))
+    os.close(ready_write)
+    os.close(handoff_read)
+    
+    loop = asyncio.get_running_loop()
+    read = loop.run_in_executor(None, os.read, ready_read, 1)
+    try:
+        ready = await asyncio.wait_for(asyncio.shield(read), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        ready = b""
+    if not ready:
+        # إنهاء النسخة الفاشلة يغلق طرف الكتابة فيعود os.read المعلق قبل إغلاق الأنبوب
+        process.kill()
+        await read
+        await loop.run_in_executor(None, process.wait)
+        os.close(ready_read)
+        os.close(handoff_write)
+        log(f"❌ لم تصبح النسخة الجديدة جاهزة خلال {DRAIN_TIMEOUT}s، الاستمرار في الخدمة", "ERROR")
+        return None
+    os.close(ready_read)
+    log(f"🔁 النسخة الجديدة {process.pid} جاهزة على المقبس نفسه", "RESTART")
+    return handoff_write
+
+
+def _write_handoff(fd, data):
+    with open(fd, "wb") as pipe:
+        pipe.write(data)
+
+
+async def receive_handoff():
+    """الأوامر المعلقة من النسخة السابقة (تصل كاملة عند انتهاء إيقافها)"""
+    loop = asyncio.get_running_loop()
+    with open(int(HANDOFF_FD), "rb") as pipe:
+        data = await loop.run_in_executor(None, pipe.read)
+    try:
+        restore_pending_commands(loads(data) if data else {})
+    except DECODE_ERRORS as e:
+        log(f"❌ تسليم أوامر غير صالح من النسخة السابقة: {e}", "ERROR")
+    schedule_command_save()
+
+
 # ==================== تشغيل السيرفر ====================
-async def main():
-    """تشغيل السيرفر"""
-    log("=" * 70, "START")
-    log("🎯 سيرفر التحكم المتكامل جاهز للعمل", "START")
-    log("=" * 70, "START")
-    log(f"📡 المنفذ: {PORT}", "START")
-    log(f"🌐 wss://your-server.onrender.com", "START")
-    log("=" * 70, "START")
-    log("📋 الأوامر المدعومة:", "START")
-    log("   ✅ REGISTER - تسجيل جهاز", "START")
-    log("   ✅ GET_DEVICES - قائمة الأجهزة", "START")
-    log("   ✅ COMMAND - أوامر التحكم", "START")
-    log("   ✅ BROADCAST - بث للجميع", "START")
-    log("   ✅ VIDEO_FRAME - بث فيديو مباشر", "START")
-    log("   ✅ PHOTO - إرسال صور", "START")
-    log("   ✅ AUDIO - إرسال تسجيلات صوتية", "START")
-    log("   ✅ AUDIO_STREAM - بث صوتي مباشر", "START")
-    log("   ✅ VOICE_COMMAND - أوامر صوتية", "START")
-    log("   ✅ GET_STATS - إحصائيات", "START")
-    log("=" * 70, "START")
-    
-    async with websockets.serve(
+async def main(host="0.0.0.0", port=PORT, bus_url=BUS_URL, reuse_port=False, ready=None):
+    """تشغيل السيرفر (أو أحد عماله عند التوسع الأفقي) حتى وصول إشارة الإيقاف"""
+    disk_writer.start()
+    if reuse_port and COMMAND_QUEUE_FILE:
+        _command_file["path"] = f"{COMMAND_QUEUE_FILE}.{os.getpid()}"
+        adopt_command_files()
+    elif not HANDOFF_FD:
+        load_pending_commands()
+    asyncio.create_task(expire_sessions())
+    asyncio.create_task(timer_wheel.run())
+    asyncio.create_task(monitor_event_loop())
+    await cluster.start(bus_url)
+    
+    listen_socket = inherited_socket()
+    ws_server = await websockets.serve(
         handler,
-        "0.0.0.0",
-        PORT,
+        None if listen_socket else host,
+        None if listen_socket else port,
+        sock=listen_socket,
         process_request=health_check,
+        compression=None,
+        extensions=server_extensions(),
         ping_interval=20,
-        ping_timeout=60
-    ):
-        await asyncio.Future()
+        ping_timeout=60,
+        max_size=MAX_MESSAGE_SIZE,
+        max_queue=INBOUND_QUEUE,
+        reuse_port=reuse_port
+    )
+    signal_ready(ready)
+    if HANDOFF_FD:
+        asyncio.create_task(receive_handoff())
+    log(f"🎯 سيرفر التحكم المتكامل جاهز - المنفذ {port} ({'مقبس موروث' if listen_socket else 'مقبس جديد'})",
+        "START", worker=WORKER_ID, serializer=SERIALIZER_NAME)
+    log(f"📋 الرسائل المدعومة: {', '.join(HANDLERS)}", "START")
+    
+    # العمال يعيد تشغيلهم المشرف (SIGHUP عليه)، فلا يورّثون المقبس
+    signals = (signal.SIGTERM, signal.SIGINT)
+    if not reuse_port:
+        signals += (signal.SIGHUP,)
+    while True:
+        received = await wait_for_signal(*signals)
+        handoff = await spawn_successor(ws_server) if received == signal.SIGHUP else None
+        if received != signal.SIGHUP or handoff is not None:
+            break
+    await drain(ws_server, handoff)
+
+
+# ==================== تشغيل عدة عمليات ====================
+def run_worker(bus_url, ready=None):
+    """نقطة دخول العامل: يشارك المنفذ نفسه مع بقية العمال عبر SO_REUSEPORT"""
+    install_event_loop()
+    try:
+        asyncio.run(main(bus_url=bus_url, reuse_port=True, ready=ready))
+    except KeyboardInterrupt:
+        pass
+
+
+async def supervise(workers, bus_url):
+    """العملية الرئيسية: تشغل الموزع المحلي (إن لزم) وتعيد تشغيل العمال المتوقفين"""
+    hub = None
+    if not bus_url:
+        path = os.path.join(tempfile.gettempdir(), f"relay-bus-{os.getpid()}.sock")
+        hub = BusHub(path)
+        await hub.start()
+        bus_url = f"unix://{path}"
+    
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    
+    def spawn(ready=None):
+        process = context.Process(target=run_worker, args=(bus_url, ready), daemon=True)
+        process.start()
+        return process
+    
+    processes = [spawn() for _ in range(workers)]
+    log(f"🧩 تشغيل {workers} عامل على المنفذ {PORT} - الناقل: {bus_url}", "CLUSTER")
+    
+    stop = asyncio.Event()
+    restart = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, restart.set)
+    retiring = []
+    
+    try:
+        while not stop.is_set():
+            if restart.is_set():
+                # إعادة تشغيل متدرجة: العمال الجدد يشاركون المنفذ (SO_REUSEPORT)، ولا يبدأ
+                # إيقاف القدامى إلا بعد أن يقبل الجدد الاتصالات
+                restart.clear()
+                ready = [context.Event() for _ in range(workers)]
+                fresh = [spawn(event) for event in ready]
+                started = await asyncio.gather(*(loop.run_in_executor(None, event.wait, DRAIN_TIMEOUT)
+                                                 for event in ready))
+                if not all(started):
+                    # نشر معطوب: يبقى العمال القدامى ويُوقف الجدد
+                    for process in fresh:
+                        process.terminate()
+                    retiring.extend(fresh)
+                    log(f"❌ لم يصبح {started.count(False)} عامل جديد جاهزاً خلال {DRAIN_TIMEOUT}s، "
+                        "الإبقاء على العمال الحاليين", "ERROR")
+                else:
+                    for process in processes:
+                        process.terminate()
+                    retiring.extend(processes)
+                    processes = fresh
+                    log(f"🔁 إعادة تشغيل {workers} عامل، القدامى في إيقاف تدريجي", "CLUSTER")
+            retiring = [process for process in retiring if process.is_alive()]
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    log(f"⚠️ توقف العامل {process.pid} (الرمز {process.exitcode})، إعادة تشغيل", "CLUSTER")
+                    processes[i] = spawn()
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes + retiring:
+            process.join(DRAIN_TIMEOUT * 3)
+        if hub:
+            await hub.close()
 
 
 # ==================== نقطة الدخول ====================
 if __name__ == "__main__":
+    install_event_loop()
     try:
-        asyncio.run(main())
+        if WORKERS > 1:
+            asyncio.run(supervise(WORKERS, BUS_URL))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        log("\n👋 تم إيقاف السيرفر", "STOP")
+        log("👋 تم إيقاف السيرفر", "STOP")
     except Exception as e:
         log(f"❌ خطأ فادح: {e}", "FATAL")
@@ -0,0 +1,51 @@
+"""الرفع المجزأ: رفعان متزامنان من الجهاز نفسه لا يتشاركان ملفاً"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import server  # noqa: E402
+
+
+class RecordingPeer:
+    device_id = "cam1"
+
+    def __init__(self):
+        self.sent = []
+
+    def send_json(self, message):
+        self.sent.append(message)
+
+
+def chunk(upload_id, offset, data, final=False):
+    meta = {"uploadId": upload_id, "offset": offset, "kind": "PHOTO"}
+    return server.MediaFrame("UPLOAD_CHUNK", "cam1", flags=server.FLAG_LAST if final else 0,
+                             meta=meta, payload=data)
+
+
+def test_concurrent_uploads_from_one_device(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server.disk_writer, "folders", set())
+    contents = {"u1": os.urandom(3000), "u2": os.urandom(3000)}
+
+    async def run():
+        peer = RecordingPeer()
+        # الأجزاء متداخلة وفي الثانية نفسها
+        for offset in (0, 1000, 2000):
+            for upload_id, data in contents.items():
+                final = offset == 2000
+                await server.handle_upload_chunk(
+                    peer, chunk(upload_id, offset, data[offset:offset + 1000], final))
+        await server.disk_writer.close()
+        return peer.sent
+
+    sent = asyncio.run(run())
+    complete = {m["uploadId"]: m for m in sent if m["type"] == "UPLOAD_COMPLETE"}
+    assert set(complete) == {"u1", "u2"}
+    assert complete["u1"]["saved_as"] != complete["u2"]["saved_as"]
+    for upload_id, data in contents.items():
+        with open(os.path.join("received_photos", complete[upload_id]["saved_as"]), "rb") as f:
+            assert f.read() == data
+    assert not [name for name in os.listdir("received_photos") if name.endswith(".part")]
+    assert not server.uploads